@@ -4,112 +4,657 @@ Classes should exist for XLNet, BERT, XLM, more? ...ELMo?
 -
 March 2020
 """
+import contextlib
+import hashlib
+import inspect
 import itertools
+import os
+import socket
+import time
 import numpy as np
 import torch
 import torch.nn.functional as F
 from tqdm import tqdm
 from transformers import AutoTokenizer, AutoModelWithLMHead
 
+def store_key(model_spec, backend='torch', precision='fp32', excluded_words=None,
+              max_pmi_distance=None):
+  """Identifies an estimator, for storing its estimates (see logpstore)"""
+  key = f'{model_spec}|{backend}|{precision}'
+  if excluded_words:
+    key += '|excluding ' + ' '.join(sorted(excluded_words))
+  if max_pmi_distance is not None:
+    key += f'|within {max_pmi_distance}'
+  return key
+
+# messages of torch's out-of-memory errors: cuda ("CUDA out of memory"),
+# the cpu allocator on linux/mac ("can't allocate memory: ... (Cannot allocate memory)"),
+# and on windows ("not enough memory")
+OUT_OF_MEMORY_MESSAGES = ('out of memory', "can't allocate memory", 'cannot allocate memory',
+                          'not enough memory')
+
+def is_out_of_memory(err):
+  """Whether a RuntimeError raised by torch is an out-of-memory error
+  (CUDA, or a failed cpu allocation)"""
+  message = str(err).lower()
+  return any(text in message for text in OUT_OF_MEMORY_MESSAGES)
+
+# variable dimensions of the inputs of exported onnx graphs
+ONNX_DYNAMIC_AXES = {
+  'input_ids': {0: 'batch', 1: 'seq_len'},
+  'perm_mask': {0: 'batch', 1: 'seq_len', 2: 'seq_len'},
+  'target_map': {0: 'batch', 2: 'seq_len'},
+  'input_index': {0: 'readouts'},
+  'target_loc': {0: 'readouts'},
+  'target_id': {0: 'readouts'},
+  'log_targets': {0: 'readouts'}}
+
+# entries of a batch with one row per readout (a target token read out of an input),
+# rather than one per input
+READOUT_KEYS = ('input_index', 'target_loc', 'target_id', 'log_p_index')
+
 class LanguageModel:
   """
   Base class for getting probability estimates from a pretrained contextual embedding model.
   Contains methods to be used by XLNet BERT XLM ...
   """
-  def __init__(self, device, model_spec, batchsize):
+  # names of the batch entries that are inputs to _log_targets
+  # (and of the inputs of the exported onnx graph)
+  onnx_inputs = ()
+
+  def __init__(
+    self, device, model_spec, batchsize, max_tokens=None,
+    precision='fp32', backend='torch', onnx_dir='onnx-models', store=None,
+    excluded_words=None, max_pmi_distance=None):
     self.device = device
+    self.model_spec = model_spec
     self.model = AutoModelWithLMHead.from_pretrained(model_spec).to(device)
+    self.model.eval()
+    if backend == 'int8':
+      # (bf16 autocast would feed bf16 activations to the quantized Linear layers)
+      if device.type != 'cpu' or precision != 'fp32':
+        raise ValueError("The 'int8' backend (dynamic quantization) only runs on cpu, in fp32.")
+      # quantizes every Linear layer, both in the encoder and the vocab projection
+      self.model = torch.quantization.quantize_dynamic(
+        self.model, {torch.nn.Linear}, dtype=torch.qint8)
+    elif backend not in ('torch', 'onnx'):
+      raise ValueError("Unknown backend. Use 'torch', 'int8', or 'onnx'")
+    self.backend = backend
     self.tokenizer = AutoTokenizer.from_pretrained(model_spec)
+    # if given, pairs of words with an excluded word (like punctuation) are not estimated
+    # (their log_p entries are NaN), except the diagonal (for pseudo log likelihood)
+    self.excluded_words = excluded_words
+    # if given, only pairs of words at most this many words apart are estimated (the others are NaN)
+    self.max_pmi_distance = max_pmi_distance
+    if backend == 'onnx':
+      if device.type != 'cpu' or precision != 'fp32':
+        raise ValueError("The 'onnx' backend only runs on cpu, in fp32.")
+      self.onnx_dir = onnx_dir
+      self._onnx_session = self._load_onnx_session(onnx_dir)
     self.batchsize = batchsize
-    print(f"Language model '{model_spec}' initialized (batchsize = {batchsize}) on {device}.")
+    # if set, batches are sized by total number of input tokens instead
+    self.max_tokens = max_tokens
+    # batch x seq_len of the last batch that ran after running out of memory
+    self._token_limit = None
+    if precision not in ('fp32', 'bf16'):
+      raise ValueError("Unknown precision. Use 'fp32' or 'bf16'")
+    self.precision = precision
+    # if given, a logpstore.LogPStore: estimates are looked up there first, and added to it
+    self.store = store
+    self.store_key = store_key(
+      model_spec, backend, precision, excluded_words, max_pmi_distance)
+    # running totals, for reporting throughput
+    self.timing = {'sentences': 0, 'tasks': 0, 'seconds': 0.}
+    size_string = f'max_tokens = {max_tokens}' if max_tokens else f'batchsize = {batchsize}'
+    print(f"Language model '{model_spec}' initialized "
+          f"({size_string}, {backend}, {precision}) on {device}.")
+
+  def _inference_mode(self):
+    """Context for running the model: no autograd bookkeeping,
+    and bfloat16 autocast if precision is 'bf16'."""
+    stack = contextlib.ExitStack()
+    stack.enter_context(torch.no_grad())
+    if self.precision == 'bf16':
+      stack.enter_context(torch.autocast(self.device.type, dtype=torch.bfloat16))
+    return stack
+
+  def _load_onnx_session(self, onnx_dir):
+    """Gets an ONNX Runtime session computing _log_targets.
+    The model is exported to onnx_dir the first time,
+    and the saved graph is reused on later runs (see _onnx_path)."""
+    import onnxruntime
+    onnx_path = self._onnx_path(onnx_dir)
+    if not os.path.exists(onnx_path):
+      self._export_onnx(onnx_path)
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.intra_op_num_threads = torch.get_num_threads()
+    return onnxruntime.InferenceSession(
+      onnx_path, options, providers=['CPUExecutionProvider'])
+
+  def _onnx_path(self, onnx_dir):
+    """Path of the exported graph in onnx_dir. The name is keyed on the model and
+    on what the graph is made from (inputs, _log_targets, torch and transformers
+    versions), so that a graph exported by other code is not reused."""
+    import transformers
+    made_from = '|'.join([
+      self.model_spec, ','.join(self.onnx_inputs), inspect.getsource(type(self)._log_targets),
+      torch.__version__, transformers.__version__])
+    digest = hashlib.sha256(made_from.encode()).hexdigest()[:12]
+    return os.path.join(
+      onnx_dir,
+      f"{type(self).__name__}-{self.model_spec.strip('/').replace('/', '_')}-{digest}.onnx")
+
+  def _export_onnx(self, onnx_path):
+    """Exports _log_targets to an onnx graph at onnx_path.
+    (The graph is written to a temporary file, and moved to onnx_path once complete,
+    so that processes sharing onnx_dir never load a partly written graph.)"""
+    os.makedirs(os.path.dirname(onnx_path) or '.', exist_ok=True)
+    print(f"Exporting '{self.model_spec}' to {onnx_path}")
+    tmp_path = f'{onnx_path}.{socket.gethostname()}-{os.getpid()}.tmp'
+    example = self._create_pmi_dataset(['an', 'example', 'sentence'], verbose=False)
+    example = example.collate_fn(example[:2])
+    example = tuple(torch.as_tensor(example[name]) for name in self.onnx_inputs)
+    # dynamic_axes needs the TorchScript exporter (newer torch defaults to dynamo)
+    export_kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+      export_kwargs['dynamo'] = False
+    with torch.no_grad():
+      torch.onnx.export(
+        LogTargetsModule(self), example, tmp_path,
+        input_names=list(self.onnx_inputs), output_names=['log_targets'],
+        dynamic_axes={name: ONNX_DYNAMIC_AXES[name]
+                      for name in self.onnx_inputs + ('log_targets',)},
+        opset_version=14, **export_kwargs)
+    os.replace(tmp_path, onnx_path)
+
+  def after_fork(self):
+    """Recreates what does not survive forking the process
+    (to be called in a forked worker, before using the model)"""
+    if self.backend == 'onnx':
+      self._onnx_session = self._load_onnx_session(self.onnx_dir)
+
+  def _onnx_log_targets(self, batch):
+    """_log_targets computed by the exported onnx graph"""
+    inputs = {name: np.ascontiguousarray(batch[name]) for name in self.onnx_inputs}
+    log_targets, = self._onnx_session.run(None, inputs)
+    return torch.from_numpy(log_targets)
 
   def _create_pmi_dataset(self, ptb_tokenlist,
     pad_left=None, pad_right=None,
     add_special_tokens=True, verbose=True):
     raise NotImplementedError
 
+  def _log_targets(self, batch):
+    """Log probabilities of the target tokens of a batch (one per readout),
+    as a tensor on device (override in implementing class)."""
+    raise NotImplementedError
+
   def ptb_tokenlist_to_pmi_matrix(
     self, ptb_tokenlist, add_special_tokens=True,
     pad_left=None, pad_right=None, verbose=True):
     """Maps tokenlist to PMI matrix, and also returns pseudo log likelihood
-    (override in implementing class)."""
-    raise NotImplementedError
+    input: ptb_tokenlist: PTB-tokenized sentence as list
+    return: pmi matrix for that sentence, pseudo log likelihood
+    """
+    return next(self.ptb_tokenlists_to_pmi_matrices(
+      [(ptb_tokenlist, pad_left, pad_right)],
+      add_special_tokens=add_special_tokens, verbose=verbose))
+
+  def ptb_tokenlists_to_pmi_matrices(
+    self, sentences, add_special_tokens=True, verbose=True, pool_size=1):
+    """Maps a sequence of sentences to PMI matrices.
+    The tasks of up to pool_size sentences at a time are pooled, grouped by
+    sequence length into shared batches, and each result is routed back to
+    the log_p matrix of its own sentence.
+    Sentences whose log_p is in the store are not estimated again.
+    input: sentences: iterable of (ptb_tokenlist, pad_left, pad_right)
+    yields: pmi matrix, pseudo log likelihood for each sentence, in order
+    """
+    sentences = iter(sentences)
+    while True:
+      pool = list(itertools.islice(sentences, pool_size))
+      if not pool:
+        return
+      keys, log_ps = self._stored_log_ps(pool, add_special_tokens)
+      missing = [k for k, log_p in enumerate(log_ps) if log_p is None]
+      if missing:
+        estimated = self._estimate_log_ps(
+          [pool[k] for k in missing], add_special_tokens=add_special_tokens, verbose=verbose)
+        for k, log_p in zip(missing, estimated):
+          log_ps[k] = log_p
+          if self.store is not None:
+            self.store.put(keys[k], log_p)
+      for log_p in log_ps:
+        yield self._log_p_to_pmi(log_p)
+
+  def ptb_tokenlists_to_pseudo_logliks(
+    self, sentences, add_special_tokens=True, verbose=True, pool_size=1):
+    """Maps a sequence of sentences to their pseudo log likelihoods only,
+    running just the diagonal tasks of each sentence (pooled as for PMI matrices),
+    unless its log_p is in the store.
+    input: sentences: iterable of (ptb_tokenlist, pad_left, pad_right)
+    yields: pseudo log likelihood for each sentence, in order
+    """
+    sentences = iter(sentences)
+    while True:
+      pool = list(itertools.islice(sentences, pool_size))
+      if not pool:
+        return
+      _, log_ps = self._stored_log_ps(pool, add_special_tokens)
+      missing = [k for k, log_p in enumerate(log_ps) if log_p is None]
+      if missing:
+        # (these partial log_p matrices are not stored)
+        estimated = self._estimate_log_ps(
+          [pool[k] for k in missing], add_special_tokens=add_special_tokens, verbose=verbose,
+          pair_masks=[np.eye(len(pool[k][0]), dtype=bool) for k in missing])
+        for k, log_p in zip(missing, estimated):
+          log_ps[k] = log_p
+      for log_p in log_ps:
+        yield np.trace(log_p)
+
+  def _stored_log_ps(self, pool, add_special_tokens=True):
+    """looks up the sentences of pool in the store
+    returns: their store keys, and their log_p (None for those not in the store)"""
+    if self.store is None:
+      return [None] * len(pool), [None] * len(pool)
+    keys = [self.store.key(self.store_key, *sentence, add_special_tokens)
+            for sentence in pool]
+    return keys, [self.store.get(key) for key in keys]
+
+  def ptb_tokenlist_to_pmi_pairs(
+    self, ptb_tokenlist, pairs, add_special_tokens=True,
+    pad_left=None, pad_right=None, verbose=True):
+    """Estimates PMI only for the given pairs of words of a sentence, running only
+    the tasks for log p(w_i | c \\ w_j) and log p(w_i | c) of each pair (i, j)
+    input: ptb_tokenlist: PTB-tokenized sentence as list
+      pairs: list of (i, j) word positions
+    return: dict of (i, j) to the pmi_matrix[i, j] that ptb_tokenlist_to_pmi_matrix would give
+    """
+    pairs = [(int(i), int(j)) for i, j in pairs]
+    pair_mask = np.zeros((len(ptb_tokenlist), len(ptb_tokenlist)), dtype=bool)
+    for i, j in pairs:
+      pair_mask[i, j] = pair_mask[i, i] = True
+    log_p, = self._estimate_log_ps(
+      [(ptb_tokenlist, pad_left, pad_right)], add_special_tokens=add_special_tokens,
+      verbose=verbose, pair_masks=[pair_mask])
+    return {(i, j): log_p[i, i] - log_p[i, j] for i, j in pairs}
+
+  def _estimate_log_ps(self, pool, add_special_tokens=True, verbose=True, pair_masks=None):
+    """Estimates the log_p matrices of a pool of sentences, in shared batches
+    input: pool: list of (ptb_tokenlist, pad_left, pad_right)
+      pair_masks: if given, the (target, source) pairs to estimate for each sentence
+        (bool arrays; the other entries are NaN)
+    returns: list of log_p matrices
+    """
+    # create datasets for observed ptb sentences
+    datasets = [self._create_pmi_dataset(
+      ptb_tokenlist, verbose=verbose,
+      pad_left=pad_left, pad_right=pad_right,
+      add_special_tokens=add_special_tokens)
+                for ptb_tokenlist, pad_left, pad_right in pool]
+    if pair_masks is not None:
+      for dataset, pair_mask in zip(datasets, pair_masks):
+        dataset.set_estimated_pairs(pair_mask)
+
+    # use model to compute PMIs
+    num_ptbtokens = [len(ptb_tokenlist) for ptb_tokenlist, _, _ in pool]
+    # offset of each sentence's (flattened) log_p in the pooled buffer
+    offsets = np.cumsum([0] + [n*n for n in num_ptbtokens])
+    # log_p is accumulated on device, and moved to host once per pool
+    log_p = torch.zeros(offsets[-1], dtype=torch.float64, device=self.device)
+    start_time = time.time()
+    with self._inference_mode():
+      for batch in self._make_pooled_batches(datasets, offsets):
+        log_targets = self._log_targets_with_backoff(batch)
+        # we accumulate all log probs for subwords in a given span
+        log_p.index_add_(
+          0, torch.as_tensor(batch['log_p_index'], device=self.device),
+          log_targets.double())
+    log_p = log_p.cpu().numpy()
+    self.timing['seconds'] += time.time() - start_time
+    self.timing['sentences'] += len(pool)
+    self.timing['tasks'] += sum(len(dataset) for dataset in datasets)
+
+    log_ps = [log_p[offsets[k]:offsets[k+1]].reshape(num, num)
+              for k, num in enumerate(num_ptbtokens)]
+    for log_p, dataset in zip(log_ps, datasets):
+      log_p[~dataset.estimated_pairs()] = np.nan
+    return log_ps
+
+  def _included_words(self, ptb_tokenlist):
+    """Which words of ptb_tokenlist are not excluded (None if none are)"""
+    if not self.excluded_words:
+      return None
+    return [word not in self.excluded_words for word in ptb_tokenlist]
+
+  @staticmethod
+  def _log_p_to_pmi(log_p):
+    """Computes PMI matrix and pseudo log likelihood from log_p"""
+    # PMI(w_i, w_j | c ) = log p(w_i | c) - log p(w_i | c \ w_j)
+    # log_p[i, i] is log p(w_i | c)
+    # log_p[i, j] is log p(w_i | c \ w_j)
+    log_p_wi_I_c = np.diag(log_p)
+    pseudo_loglik = np.trace(log_p)
+    pmi_matrix = log_p_wi_I_c[:, None] - log_p
+    return pmi_matrix, pseudo_loglik
+
+  def _batchsize_for(self, seq_len):
+    """Number of tasks per batch for inputs of length seq_len"""
+    if self.max_tokens:
+      batchsize = self.max_tokens // seq_len
+    else:
+      batchsize = self.batchsize
+    if self._token_limit:
+      batchsize = min(batchsize, self._token_limit // seq_len)
+    return max(1, batchsize)
+
+  def _log_targets_with_backoff(self, batch):
+    """Runs _log_targets on a batch; if it runs out of memory, the batch is
+    split in two and retried, and the size that fits is remembered
+    for the following batches."""
+    try:
+      if self.backend == 'onnx':
+        return self._onnx_log_targets(batch)
+      return self._log_targets(batch)
+    except RuntimeError as err:
+      if not is_out_of_memory(err) or len(batch['input_ids']) == 1:
+        raise
+    # (retry outside of the except clause, so that the failed batch can be freed)
+    if self.device.type == 'cuda':
+      torch.cuda.empty_cache()
+    batchsize, seq_len = batch['input_ids'].shape
+    half = (batchsize + 1) // 2
+    self._token_limit = half * seq_len
+    print(f"Out of memory on {batchsize} inputs of length {seq_len}, "
+          f"retrying in batches of {half}.")
+    log_targets = []
+    start = 0
+    while start < batchsize:
+      # (the limit may shrink further while retrying)
+      size = max(1, self._token_limit // seq_len)
+      log_targets.append(self._log_targets_with_backoff(
+        self._slice_batch(batch, start, start+size)))
+      start += size
+    return torch.cat(log_targets)
+
+  @staticmethod
+  def _slice_batch(batch, start, stop):
+    """the inputs start:stop of a batch, with their readouts"""
+    # (readouts are ordered by input)
+    first, last = np.searchsorted(batch['input_index'], [start, stop])
+    tbatch = {}
+    for key, value in batch.items():
+      if key in READOUT_KEYS:
+        tbatch[key] = value[first:last]
+      else:
+        tbatch[key] = value[start:stop]
+    tbatch['input_index'] = tbatch['input_index'] - start
+    return tbatch
+
+  def _make_pooled_batches(self, datasets, offsets):
+    """Yields batches of tasks taken from all datasets.
+    Only inputs of the same length are batched together (so no padding is
+    needed, and results are the same as when running sentences one by one).
+    The size of each batch is given by _batchsize_for its input length.
+    The log_p_index of each task is shifted by the offset of its sentence.
+    """
+    by_length = {}
+    for k, dataset in enumerate(datasets):
+      by_length.setdefault(len(dataset.input_ids), []).append(k)
+    progress = tqdm(total=sum(len(dataset) for dataset in datasets), leave=False)
+    for seq_len, ks in by_length.items():
+      # (sentence, task) pairs for all tasks of this length
+      sentence_ids = np.concatenate(
+        [np.full(len(datasets[k]), k) for k in ks]).astype(np.int64)
+      task_ids = np.concatenate([np.arange(len(datasets[k])) for k in ks])
+      start = 0
+      while start < len(task_ids):
+        # (checked for every batch, since it may shrink after running out of memory)
+        batchsize = self._batchsize_for(seq_len)
+        block_sentences = sentence_ids[start:start+batchsize]
+        block_tasks = task_ids[start:start+batchsize]
+        parts = []
+        for k in np.unique(block_sentences):
+          tbatch = datasets[k].collate_fn(datasets[k][block_tasks[block_sentences == k]])
+          tbatch['log_p_index'] = tbatch['log_p_index'] + offsets[k]
+          parts.append(tbatch)
+        start += batchsize
+        yield parts[0] if len(parts) == 1 else self._concat_batches(parts)
+        progress.update(len(block_tasks))
+    progress.close()
+
+  @staticmethod
+  def _concat_batches(tbatches):
+    """concatenate batches built from different datasets"""
+    tbatch = {}
+    for key, value in tbatches[0].items():
+      if torch.is_tensor(value):
+        tbatch[key] = torch.cat([b[key] for b in tbatches])
+      else:
+        tbatch[key] = np.concatenate([b[key] for b in tbatches])
+    # readouts refer to inputs by their index in the concatenated batch
+    input_offsets = np.cumsum([0] + [len(b['input_ids']) for b in tbatches[:-1]])
+    tbatch['input_index'] = np.concatenate(
+      [b['input_index'] + offset for b, offset in zip(tbatches, input_offsets)])
+    return tbatch
 
   def make_subword_lists(self, ptb_tokenlist, add_special_tokens=False):
     raise NotImplementedError
 
-class XLNetSentenceDataset(torch.utils.data.Dataset):
-  """Dataset class for XLNet"""
+class StoredEstimates:
+  """
+  Stands in for a LanguageModel when all the estimates needed are in a store
+  (so that sentences can be re-scored without loading the model).
+  """
+  def __init__(
+    self, store, model_spec, backend='torch', precision='fp32', excluded_words=None,
+    max_pmi_distance=None):
+    self.store = store
+    self.model_spec = model_spec
+    self.backend = backend
+    self.precision = precision
+    self.excluded_words = excluded_words
+    self.max_pmi_distance = max_pmi_distance
+    self.store_key = store_key(
+      model_spec, backend, precision, excluded_words, max_pmi_distance)
+    self.timing = {'sentences': 0, 'tasks': 0, 'seconds': 0.}
+
+  def has_estimates(self, sentences, add_special_tokens=True):
+    """whether all sentences (ptb_tokenlist, pad_left, pad_right) are in the store"""
+    return all(self.store.key(self.store_key, *sentence, add_special_tokens) in self.store
+               for sentence in sentences)
+
+  def after_fork(self):
+    pass
+
+  def ptb_tokenlist_to_pmi_matrix(
+    self, ptb_tokenlist, add_special_tokens=True,
+    pad_left=None, pad_right=None, verbose=True):
+    return next(self.ptb_tokenlists_to_pmi_matrices(
+      [(ptb_tokenlist, pad_left, pad_right)], add_special_tokens=add_special_tokens))
+
+  def ptb_tokenlists_to_pmi_matrices(
+    self, sentences, add_special_tokens=True, verbose=True, pool_size=1):
+    for sentence in sentences:
+      log_p = self.store.get(self.store.key(self.store_key, *sentence, add_special_tokens))
+      if log_p is None:
+        raise KeyError(f'No estimate in the store for {sentence}.')
+      yield LanguageModel._log_p_to_pmi(log_p)
+
+  def ptb_tokenlists_to_pseudo_logliks(
+    self, sentences, add_special_tokens=True, verbose=True, pool_size=1):
+    for _, pseudo_loglik in self.ptb_tokenlists_to_pmi_matrices(
+        sentences, add_special_tokens=add_special_tokens):
+      yield pseudo_loglik
+
+class LogTargetsModule(torch.nn.Module):
+  """Wraps the _log_targets method of a LanguageModel as a module
+  taking its onnx_inputs as arguments, for exporting to onnx"""
+  def __init__(self, language_model):
+    super().__init__()
+    self.model = language_model.model
+    self.language_model = language_model
+
+  def forward(self, *inputs):
+    return self.language_model._log_targets(
+      dict(zip(self.language_model.onnx_inputs, inputs)))
+
+class SentenceDataset(torch.utils.data.Dataset):
+  """
+  Base dataset class for the masked inputs of a single sentence.
+  Tasks are stored as a compact index (source span id, target span id, subword offset);
+  the masked inputs are built for a whole block of tasks at once by collate_fn.
+  Each task is one input, read out at its target token, and possibly at others
+  (see shares_symmetric_inputs).
+  """
+  # If True, the input of the first subword of target span j with source span i masks
+  # all of both spans, as does the one for the first subword of span i with source span j,
+  # so only the first is made, and it is read out for both (exact, for masked LMs).
+  shares_symmetric_inputs = False
+
   def __init__(
     self, input_ids, ptbtok_to_span, span_to_ptbtok,
-    mask_token_id=6, n_pad_left=0, n_pad_right=0):
+    mask_token_id, n_pad_left=0, n_pad_right=0, included=None, max_distance=None):
     self.input_ids = input_ids
     self.n_pad_left = n_pad_left
     self.n_pad_right = n_pad_right
     self.mask_token_id = mask_token_id
     self.ptbtok_to_span = ptbtok_to_span
     self.span_to_ptbtok = span_to_ptbtok
+    # template input, and absolute [start, end) positions of each span in it
+    self._template = np.array(input_ids, dtype=np.int64)
+    self._span_start = np.array(
+      [self.n_pad_left + (span[0] if span else 0) for span in ptbtok_to_span], dtype=np.int64)
+    self._span_end = self._span_start + [len(span) for span in ptbtok_to_span]
+    # which words to estimate pairs of (None for all),
+    # and how many words apart they can be at most (None for any distance)
+    self.included = None if included is None else np.array(included, dtype=bool)
+    self.max_distance = max_distance
+    # explicit pairs to estimate (see set_estimated_pairs), instead of the above
+    self._pair_mask = None
     self._make_tasks()
 
-  @staticmethod
-  def collate_fn(batch):
-    """concatenate and prepare batch"""
-    tbatch = {}
-    tbatch["input_ids"] = torch.LongTensor([b['input_ids'] for b in batch])
-    tbatch["perm_mask"] = torch.FloatTensor([b['perm_mask'] for b in batch])
-    tbatch["target_map"] = torch.FloatTensor([b['target_map'] for b in batch])
-    tbatch["target_id"] = [b['target_id'] for b in batch]
-    tbatch["source_span"] = [b['source_span'] for b in batch]
-    tbatch["target_span"] = [b['target_span'] for b in batch]
-    return tbatch
+  def set_estimated_pairs(self, pair_mask):
+    """Makes tasks only for the (target, source) pairs that are True in pair_mask
+    (bool array n_words x n_words; the diagonal is not added)"""
+    self._pair_mask = np.array(pair_mask, dtype=bool)
+    self._make_tasks()
+
+  def estimated_pairs(self):
+    """bool array (n_words x n_words), True for the (target, source) pairs with tasks:
+    every pair of included words at most max_distance apart, and the diagonal
+    (or the pairs set by set_estimated_pairs)"""
+    if self._pair_mask is not None:
+      return self._pair_mask
+    n_words = len(self.ptbtok_to_span)
+    estimated = np.ones((n_words, n_words), dtype=bool)
+    if self.included is not None:
+      estimated &= self.included[:, None] & self.included[None, :]
+    if self.max_distance is not None:
+      positions = np.arange(n_words)
+      estimated &= np.abs(positions[:, None] - positions[None, :]) <= self.max_distance
+    return estimated | np.eye(n_words, dtype=bool)
 
   def _make_tasks(self):
+    estimated_pairs = self._estimated_pairs = self.estimated_pairs()
     tasks = []
-    len_s = len(self.input_ids) # length in subword tokens
-    len_t = len(self.ptbtok_to_span) # length in ptb tokens
-    for source_span in self.ptbtok_to_span:
-      for target_span in self.ptbtok_to_span:
-        for idx_target, target_pos in enumerate(target_span):
-          # these are the positions of the source span
-          abs_source = [self.n_pad_left + s for s in source_span]
-          # this is the token we want to predict in the target span
-          abs_target_curr = self.n_pad_left + target_pos
-          # these are all the tokens we need to mask in the target span
-          abs_target_next = [self.n_pad_left + t
-                             for t in target_span[idx_target:]]
-          # we replace all hidden target tokens with <mask>
-          input_ids = np.array(self.input_ids)
-          input_ids[abs_target_next] = self.mask_token_id
-          # create permutation mask
-          perm_mask = np.zeros((len_s, len_s))
-          perm_mask[:, abs_target_next] = 1.
-          # if the source span is different from target span,
-          # then we need to mask all of its tokens
-          if source_span != target_span:
-            input_ids[abs_source] = self.mask_token_id
-            perm_mask[:, abs_source] = 1.
-          # build prediction map
-          target_map = np.zeros((1, len_s))
-          target_map[0, abs_target_curr] = 1.
-          # build all
-          task_dict = {}
-          task_dict["input_ids"] = input_ids
-          task_dict["source_span"] = source_span
-          task_dict["target_span"] = target_span
-          task_dict["target_map"] = target_map
-          task_dict["perm_mask"] = perm_mask
-          task_dict["target_id"] = self.input_ids[abs_target_curr]
-          tasks.append(task_dict)
-    self._tasks = tasks
+    for source_id, source_span in enumerate(self.ptbtok_to_span):
+      for target_id, target_span in enumerate(self.ptbtok_to_span):
+        if not estimated_pairs[target_id, source_id]:
+          continue
+        for idx_target, _ in enumerate(target_span):
+          if (self.shares_symmetric_inputs and idx_target == 0
+              and source_id > target_id and source_span
+              and estimated_pairs[source_id, target_id]):
+            # (read out of the input for target_id -> source_id)
+            continue
+          tasks.append((source_id, target_id, idx_target))
+    self._tasks = np.array(tasks, dtype=np.int64).reshape(-1, 3)
+
+  def _make_batch(self, tasks):
+    """Builds the masked inputs for a block of tasks in one step.
+    Args:
+      tasks: int array of shape (batch, 3), rows of the task index
+    Returns:
+      tbatch: dict with input_ids (LongTensor, batch x len_s), and for each readout
+        (ordered by input) the index of its input, the location and id
+        of the token to predict, and its entry in log_p
+      is_masked: bool array (batch x len_s), True at the masked positions
+    """
+    source_id, target_id, idx_target = tasks[:, 0], tasks[:, 1], tasks[:, 2]
+    # this is the token we want to predict in the target span
+    target_loc = self._span_start[target_id] + idx_target
+    positions = np.arange(len(self._template))[None, :]
+    # we mask all the tokens of the target span from the current one on
+    is_masked = ((positions >= target_loc[:, None])
+                 & (positions < self._span_end[target_id][:, None]))
+    # if the source span is different from target span,
+    # then we need to mask all of its tokens
+    is_masked |= ((source_id != target_id)[:, None]
+                  & (positions >= self._span_start[source_id][:, None])
+                  & (positions < self._span_end[source_id][:, None]))
+    input_ids = np.where(is_masked, self.mask_token_id, self._template[None, :])
+    input_index = np.arange(len(tasks))
+    if self.shares_symmetric_inputs:
+      # inputs masking all of both spans are also read out at the first token of the source
+      shared = ((idx_target == 0) & (source_id < target_id)
+                & (self._span_end[source_id] > self._span_start[source_id])
+                & self._estimated_pairs[source_id, target_id])
+      input_index = np.concatenate([input_index, np.flatnonzero(shared)])
+      target_loc = np.concatenate([target_loc, self._span_start[source_id[shared]]])
+      source_id, target_id = (np.concatenate([source_id, target_id[shared]]),
+                              np.concatenate([target_id, source_id[shared]]))
+      order = np.argsort(input_index, kind='stable')
+      input_index, target_loc = input_index[order], target_loc[order]
+      source_id, target_id = source_id[order], target_id[order]
+    tbatch = {}
+    tbatch["input_ids"] = torch.from_numpy(input_ids)
+    tbatch["input_index"] = input_index
+    tbatch["target_loc"] = target_loc
+    tbatch["target_id"] = self._template[target_loc]
+    # flat index of the (target word, source word) entry of log_p
+    tbatch["log_p_index"] = target_id * len(self.ptbtok_to_span) + source_id
+    return tbatch, is_masked
+
+  def collate_fn(self, tasks):
+    """prepare batch for a block of tasks (override in implementing class)"""
+    raise NotImplementedError
 
   def __len__(self):
     return len(self._tasks)
 
   def __getitem__(self, idx):
+    # idx can be a single index or a block of indices
     return self._tasks[idx]
 
+class XLNetSentenceDataset(SentenceDataset):
+  """Dataset class for XLNet"""
+  def __init__(
+    self, input_ids, ptbtok_to_span, span_to_ptbtok,
+    mask_token_id=6, n_pad_left=0, n_pad_right=0, included=None, max_distance=None):
+    super().__init__(
+      input_ids, ptbtok_to_span, span_to_ptbtok,
+      mask_token_id=mask_token_id, n_pad_left=n_pad_left, n_pad_right=n_pad_right,
+      included=included, max_distance=max_distance)
+
+  def collate_fn(self, tasks):
+    """prepare batch, with permutation mask and prediction map"""
+    tbatch, is_masked = self._make_batch(tasks)
+    batchsize, len_s = is_masked.shape
+    # no position can see the masked positions
+    tbatch["perm_mask"] = torch.from_numpy(is_masked).float()[:, None, :].expand(
+      batchsize, len_s, len_s)
+    # build prediction map
+    target_map = torch.zeros((batchsize, 1, len_s))
+    target_map[torch.arange(batchsize), 0, torch.from_numpy(tbatch.pop("target_loc"))] = 1.
+    tbatch["target_map"] = target_map
+    return tbatch
+
 class XLNet(LanguageModel):
   """Class for using XLNet as estimator"""
+  onnx_inputs = ('input_ids', 'perm_mask', 'target_map', 'target_id')
+
   # def __init__(self, device, model_spec, batchsize):
     # from transformers import XLNetLMHeadModel, XLNetTokenizer
     # self.device = device
@@ -164,71 +709,23 @@ class XLNet(LanguageModel):
       print(f'padleft:{pad_left}\npadright:{pad_right}')
       print(f'input_ids:{ids}')
 
-    # setup data loader
+    # setup dataset
     dataset = XLNetSentenceDataset(
       ids, ptbtok_to_span, span_to_ptbtok,
       mask_token_id=self.tokenizer.mask_token_id,
-      n_pad_left=n_pad_left, n_pad_right=n_pad_right)
-    loader = torch.utils.data.DataLoader(
-      dataset, shuffle=False, batch_size=self.batchsize,
-      collate_fn=XLNetSentenceDataset.collate_fn)
-    return dataset, loader
-
-  def ptb_tokenlist_to_pmi_matrix(
-    self, ptb_tokenlist, add_special_tokens=True,
-    pad_left=None, pad_right=None, verbose=True):
-
-    # create dataset for observed ptb sentence
-    dataset, loader = self._create_pmi_dataset(
-      ptb_tokenlist, verbose=verbose,
-      pad_left=pad_left, pad_right=pad_right,
-      add_special_tokens=add_special_tokens)
-
-    # use model to compute PMIs
-    results = []
-    for batch in tqdm(loader, leave=False):
-      outputs = self.model(
-        batch['input_ids'].to(self.device),
-        perm_mask=batch['perm_mask'].to(self.device),
-        target_mapping=batch['target_map'].to(self.device))
-      outputs = F.log_softmax(outputs[0], 2)
-      for i, output in enumerate(outputs):
-        # the token id we need to predict, this belongs to target span
-        target_id = batch['target_id'][i]
-        assert output.size(0) == 1
-        log_target = output[0, target_id].item()
-        result_dict = {}
-        result_dict['source_span'] = batch['source_span'][i]
-        result_dict['target_span'] = batch['target_span'][i]
-        result_dict['log_target'] = log_target
-        result_dict['target_id'] = target_id
-        results.append(result_dict)
-
-    num_ptbtokens = len(ptb_tokenlist)
-    log_p = np.zeros((num_ptbtokens, num_ptbtokens))
-    # num = np.zeros((num_ptbtokens, num_ptbtokens))
-    for result in results:
-      log_target = result['log_target']
-      source_span = result['source_span']
-      target_span = result['target_span']
-      ptbtok_source = dataset.span_to_ptbtok[source_span]
-      ptbtok_target = dataset.span_to_ptbtok[target_span]
-      if len(target_span) == 1:
-        # sanity check: if target_span is 1 token, then we don't need
-        # to accumulate subwords probabilities
-        assert log_p[ptbtok_target, ptbtok_source] == 0.
-      # we accumulate all log probs for subwords in a given span
-      log_p[ptbtok_target, ptbtok_source] += log_target
-      # num[ptbtok_target, ptbtok_source] += 1
-    # print(f'num:\n{num}')
-
-    # PMI(w_i, w_j | c ) = log p(w_i | c) - log p(w_i | c \ w_j)
-    # log_p[i, i] is log p(w_i | c)
-    # log_p[i, j] is log p(w_i | c \ w_j)
-    log_p_wi_I_c = np.diag(log_p)
-    pseudo_loglik = np.trace(log_p) 
-    pmi_matrix = log_p_wi_I_c[:, None] - log_p
-    return pmi_matrix, pseudo_loglik
+      n_pad_left=n_pad_left, n_pad_right=n_pad_right,
+      included=self._included_words(ptb_tokenlist), max_distance=self.max_pmi_distance)
+    return dataset
+
+  def _log_targets(self, batch):
+    outputs = self.model(
+      batch['input_ids'].to(self.device),
+      perm_mask=batch['perm_mask'].to(self.device),
+      target_mapping=batch['target_map'].to(self.device))
+    outputs = F.log_softmax(outputs[0][:, 0], -1)
+    # the token id we need to predict, this belongs to target span
+    target_id = torch.as_tensor(batch['target_id'], device=self.device)
+    return outputs.gather(1, target_id[:, None])[:, 0]
 
   def make_subword_lists(self, ptb_tokenlist, add_special_tokens=False):
     '''
@@ -282,70 +779,28 @@ class XLNet(LanguageModel):
         pos += 1
     return tokens, ptbtok_to_span
 
-class BERTSentenceDataset(torch.utils.data.Dataset):
+class BERTSentenceDataset(SentenceDataset):
   """Dataset class for BERT"""
+  shares_symmetric_inputs = True
 
   def __init__(
     self, input_ids, ptbtok_to_span, span_to_ptbtok,
-    mask_token_id=103, n_pad_left=0, n_pad_right=0):
-    self.input_ids = input_ids
-    self.n_pad_left = n_pad_left
-    self.n_pad_right = n_pad_right
-    self.mask_token_id = mask_token_id
-    self.ptbtok_to_span = ptbtok_to_span
-    self.span_to_ptbtok = span_to_ptbtok
-    self._make_tasks()
-
-  @staticmethod
-  def collate_fn(batch):
-    """concatenate and prepare batch"""
-    tbatch = {}
-    tbatch["input_ids"] = torch.LongTensor([b['input_ids'] for b in batch])
-    tbatch["target_loc"] = [b['target_loc'] for b in batch]
-    tbatch["target_id"] = [b['target_id'] for b in batch]
-    tbatch["source_span"] = [b['source_span'] for b in batch]
-    tbatch["target_span"] = [b['target_span'] for b in batch]
+    mask_token_id=103, n_pad_left=0, n_pad_right=0, included=None, max_distance=None):
+    super().__init__(
+      input_ids, ptbtok_to_span, span_to_ptbtok,
+      mask_token_id=mask_token_id, n_pad_left=n_pad_left, n_pad_right=n_pad_right,
+      included=included, max_distance=max_distance)
+
+  def collate_fn(self, tasks):
+    """prepare batch (the location in the input list to predict is target_loc,
+    since the model predicts all)"""
+    tbatch, _ = self._make_batch(tasks)
     return tbatch
 
-  def _make_tasks(self):
-    tasks = []
-    for source_span in self.ptbtok_to_span:
-      for target_span in self.ptbtok_to_span:
-        for idx_target, target_pos in enumerate(target_span):
-          # these are the positions of the source span
-          abs_source = [self.n_pad_left + s for s in source_span]
-          # this is the token we want to predict in the target span
-          abs_target_curr = self.n_pad_left + target_pos
-          # these are all the tokens we need to mask in the target span
-          abs_target_next = [self.n_pad_left + t
-                             for t in target_span[idx_target:]]
-          # we replace all hidden target tokens with [MASK]
-          input_ids = np.array(self.input_ids)
-          input_ids[abs_target_next] = self.mask_token_id
-          # if the source span is different from target span,
-          # then we need to mask all of its tokens
-          if source_span != target_span:
-            input_ids[abs_source] = self.mask_token_id
-          # the location in the input list to predict (since bert predicts all)
-          target_loc = abs_target_curr
-          # build all
-          task_dict = {}
-          task_dict["input_ids"] = input_ids
-          task_dict["source_span"] = source_span
-          task_dict["target_span"] = target_span
-          task_dict["target_loc"] = target_loc
-          task_dict["target_id"] = self.input_ids[abs_target_curr]
-          tasks.append(task_dict)
-    self._tasks = tasks
-
-  def __len__(self):
-    return len(self._tasks)
-
-  def __getitem__(self, idx):
-    return self._tasks[idx]
-
 class BERT(LanguageModel):
   """Class for using BERT as estimator"""
+  onnx_inputs = ('input_ids', 'input_index', 'target_loc', 'target_id')
+
   # def __init__(self, device, model_spec, batchsize):
   #   from transformers import BertForMaskedLM, BertTokenizer
   #   self.device = device
@@ -402,75 +857,28 @@ class BERT(LanguageModel):
       print(f'padleft:{pad_left}\npadright:{pad_right}')
       print(f'input_ids:{ids}')
 
-    # setup data loader
+    # setup dataset
     dataset = BERTSentenceDataset(
       ids, ptbtok_to_span, span_to_ptbtok,
       mask_token_id=self.tokenizer.mask_token_id,
-      n_pad_left=n_pad_left, n_pad_right=n_pad_right)
-    loader = torch.utils.data.DataLoader(
-      dataset, shuffle=False, batch_size=self.batchsize,
-      collate_fn=BERTSentenceDataset.collate_fn)
-    return dataset, loader
+      n_pad_left=n_pad_left, n_pad_right=n_pad_right,
+      included=self._included_words(ptb_tokenlist), max_distance=self.max_pmi_distance)
+    return dataset
   
-  def ptb_tokenlist_to_pmi_matrix(
-    self, ptb_tokenlist, add_special_tokens=True,
-    pad_left=None, pad_right=None, verbose=True):
-    '''
-    input: ptb_tokenlist: PTB-tokenized sentence as list
-    return: pmi matrix for that sentence
-    '''
-
-    # create dataset for observed ptb sentence
-    dataset, loader = self._create_pmi_dataset(
-      ptb_tokenlist, verbose=verbose,
-      pad_left=pad_left, pad_right=pad_right,
-      add_special_tokens=add_special_tokens)
-
-    # use model to compute PMIs
-    results = []
-    for batch in tqdm(loader, leave=False):
-      outputs = self.model(
-        batch['input_ids'].to(self.device))
-      outputs = F.log_softmax(outputs[0], 2)
-      for i, output in enumerate(outputs):
-        # the token id we need to predict, this belongs to target span
-        target_id = batch['target_id'][i]
-        input_ids = batch['input_ids'][i]
-        target_loc = batch['target_loc'][i]
-        assert output.size(0) == len(input_ids)
-        log_target = output[target_loc, target_id].item()
-        result_dict = {}
-        result_dict['source_span'] = batch['source_span'][i]
-        result_dict['target_span'] = batch['target_span'][i]
-        result_dict['log_target'] = log_target
-        result_dict['target_id'] = target_id
-        results.append(result_dict)
-
-    num_ptbtokens = len(ptb_tokenlist)
-    log_p = np.zeros((num_ptbtokens, num_ptbtokens))
-    # num = np.zeros((num_ptbtokens, num_ptbtokens))
-    for result in results:
-      log_target = result['log_target']
-      source_span = result['source_span']
-      target_span = result['target_span']
-      ptbtok_source = dataset.span_to_ptbtok[source_span]
-      ptbtok_target = dataset.span_to_ptbtok[target_span]
-      if len(target_span) == 1:
-        # sanity check: if target_span is 1 token, then we don't need
-        # to accumulate subwords probabilities
-        assert log_p[ptbtok_target, ptbtok_source] == 0.
-      # we accumulate all log probs for subwords in a given span
-      log_p[ptbtok_target, ptbtok_source] += log_target
-      # num[ptbtok_target, ptbtok_source] += 1
-    # print(f'num:\n{num}')
-
-    # PMI(w_i, w_j | c ) = log p(w_i | c) - log p(w_i | c \ w_j)
-    # log_p[i, i] is log p(w_i | c)
-    # log_p[i, j] is log p(w_i | c \ w_j)
-    log_p_wi_I_c = np.diag(log_p)
-    pseudo_loglik = np.trace(log_p) 
-    pmi_matrix = log_p_wi_I_c[:, None] - log_p
-    return pmi_matrix, pseudo_loglik
+  def _log_softmax_at_target(self, input_ids, input_index, target_loc):
+    """Runs the encoder on the batch, then applies the LM head only at the
+    target locations of the inputs (not at every position).
+    Returns: a (readouts, vocab) tensor of log probabilities"""
+    hidden = self.model.base_model(input_ids)[0]
+    hidden = hidden[torch.as_tensor(input_index), torch.as_tensor(target_loc)]
+    return F.log_softmax(self.model.cls(hidden), -1)
+
+  def _log_targets(self, batch):
+    outputs = self._log_softmax_at_target(
+      batch['input_ids'].to(self.device), batch['input_index'], batch['target_loc'])
+    # the token id we need to predict, this belongs to target span
+    target_id = torch.as_tensor(batch['target_id'], device=self.device)
+    return outputs.gather(1, target_id[:, None])[:, 0]
 
   def make_subword_lists(self, ptb_tokenlist, add_special_tokens=False):
     '''
@@ -516,70 +924,28 @@ class BERT(LanguageModel):
         pos += 1
     return tokens, ptbtok_to_span
 
-class XLMSentenceDataset(torch.utils.data.Dataset):
+class XLMSentenceDataset(SentenceDataset):
   """Dataset class for XLM"""
+  shares_symmetric_inputs = True
 
   def __init__(
     self, input_ids, ptbtok_to_span, span_to_ptbtok,
-    mask_token_id=5, n_pad_left=0, n_pad_right=0):
-    self.input_ids = input_ids
-    self.n_pad_left = n_pad_left
-    self.n_pad_right = n_pad_right
-    self.mask_token_id = mask_token_id
-    self.ptbtok_to_span = ptbtok_to_span
-    self.span_to_ptbtok = span_to_ptbtok
-    self._make_tasks()
-
-  @staticmethod
-  def collate_fn(batch):
-    """concatenate and prepare batch"""
-    tbatch = {}
-    tbatch["input_ids"] = torch.LongTensor([b['input_ids'] for b in batch])
-    tbatch["target_loc"] = [b['target_loc'] for b in batch]
-    tbatch["target_id"] = [b['target_id'] for b in batch]
-    tbatch["source_span"] = [b['source_span'] for b in batch]
-    tbatch["target_span"] = [b['target_span'] for b in batch]
+    mask_token_id=5, n_pad_left=0, n_pad_right=0, included=None, max_distance=None):
+    super().__init__(
+      input_ids, ptbtok_to_span, span_to_ptbtok,
+      mask_token_id=mask_token_id, n_pad_left=n_pad_left, n_pad_right=n_pad_right,
+      included=included, max_distance=max_distance)
+
+  def collate_fn(self, tasks):
+    """prepare batch (the location in the input list to predict is target_loc,
+    since the model predicts all)"""
+    tbatch, _ = self._make_batch(tasks)
     return tbatch
 
-  def _make_tasks(self):
-    tasks = []
-    for source_span in self.ptbtok_to_span:
-      for target_span in self.ptbtok_to_span:
-        for idx_target, target_pos in enumerate(target_span):
-          # these are the positions of the source span
-          abs_source = [self.n_pad_left + s for s in source_span]
-          # this is the token we want to predict in the target span
-          abs_target_curr = self.n_pad_left + target_pos
-          # these are all the tokens we need to mask in the target span
-          abs_target_next = [self.n_pad_left + t
-                             for t in target_span[idx_target:]]
-          # we replace all hidden target tokens with the mask token <special1>
-          input_ids = np.array(self.input_ids)
-          input_ids[abs_target_next] = self.mask_token_id
-          # if the source span is different from target span,
-          # then we need to mask all of its tokens
-          if source_span != target_span:
-            input_ids[abs_source] = self.mask_token_id
-          # the location in the input list to predict (since bert predicts all)
-          target_loc = abs_target_curr
-          # build all
-          task_dict = {}
-          task_dict["input_ids"] = input_ids
-          task_dict["source_span"] = source_span
-          task_dict["target_span"] = target_span
-          task_dict["target_loc"] = target_loc
-          task_dict["target_id"] = self.input_ids[abs_target_curr]
-          tasks.append(task_dict)
-    self._tasks = tasks
-
-  def __len__(self):
-    return len(self._tasks)
-
-  def __getitem__(self, idx):
-    return self._tasks[idx]
-
 class XLM(LanguageModel):
   """Class for using XLM as estimator"""
+  onnx_inputs = ('input_ids', 'input_index', 'target_loc', 'target_id')
+
   # def __init__(self, device, model_spec, batchsize):
   #   from transformers import XLMWithLMHeadModel, XLMTokenizer
   #   self.device = device
@@ -636,75 +1002,28 @@ class XLM(LanguageModel):
       print(f'padleft:{pad_left}\npadright:{pad_right}')
       print(f'input_ids:{ids}')
 
-    # setup data loader
+    # setup dataset
     dataset = XLMSentenceDataset(
       ids, ptbtok_to_span, span_to_ptbtok,
       mask_token_id=self.tokenizer.mask_token_id,
-      n_pad_left=n_pad_left, n_pad_right=n_pad_right)
-    loader = torch.utils.data.DataLoader(
-      dataset, shuffle=False, batch_size=self.batchsize,
-      collate_fn=XLMSentenceDataset.collate_fn)
-    return dataset, loader
+      n_pad_left=n_pad_left, n_pad_right=n_pad_right,
+      included=self._included_words(ptb_tokenlist), max_distance=self.max_pmi_distance)
+    return dataset
   
-  def ptb_tokenlist_to_pmi_matrix(
-    self, ptb_tokenlist, add_special_tokens=True,
-    pad_left=None, pad_right=None, verbose=True):
-    '''
-    input: ptb_tokenlist: PTB-tokenized sentence as list
-    return: pmi matrix for that sentence
-    '''
-
-    # create dataset for observed ptb sentence
-    dataset, loader = self._create_pmi_dataset(
-      ptb_tokenlist, verbose=verbose,
-      pad_left=pad_left, pad_right=pad_right,
-      add_special_tokens=add_special_tokens)
-
-    # use model to compute PMIs
-    results = []
-    for batch in tqdm(loader, leave=False):
-      outputs = self.model(
-        batch['input_ids'].to(self.device))
-      outputs = F.log_softmax(outputs[0], 2)
-      for i, output in enumerate(outputs):
-        # the token id we need to predict, this belongs to target span
-        target_id = batch['target_id'][i]
-        input_ids = batch['input_ids'][i]
-        target_loc = batch['target_loc'][i]
-        assert output.size(0) == len(input_ids)
-        log_target = output[target_loc, target_id].item()
-        result_dict = {}
-        result_dict['source_span'] = batch['source_span'][i]
-        result_dict['target_span'] = batch['target_span'][i]
-        result_dict['log_target'] = log_target
-        result_dict['target_id'] = target_id
-        results.append(result_dict)
-
-    num_ptbtokens = len(ptb_tokenlist)
-    log_p = np.zeros((num_ptbtokens, num_ptbtokens))
-    # num = np.zeros((num_ptbtokens, num_ptbtokens))
-    for result in results:
-      log_target = result['log_target']
-      source_span = result['source_span']
-      target_span = result['target_span']
-      ptbtok_source = dataset.span_to_ptbtok[source_span]
-      ptbtok_target = dataset.span_to_ptbtok[target_span]
-      if len(target_span) == 1:
-        # sanity check: if target_span is 1 token, then we don't need
-        # to accumulate subwords probabilities
-        assert log_p[ptbtok_target, ptbtok_source] == 0.
-      # we accumulate all log probs for subwords in a given span
-      log_p[ptbtok_target, ptbtok_source] += log_target
-      # num[ptbtok_target, ptbtok_source] += 1
-    # print(f'num:\n{num}')
-
-    # PMI(w_i, w_j | c ) = log p(w_i | c) - log p(w_i | c \ w_j)
-    # log_p[i, i] is log p(w_i | c)
-    # log_p[i, j] is log p(w_i | c \ w_j)
-    log_p_wi_I_c = np.diag(log_p)
-    pseudo_loglik = np.trace(log_p) 
-    pmi_matrix = log_p_wi_I_c[:, None] - log_p
-    return pmi_matrix, pseudo_loglik
+  def _log_softmax_at_target(self, input_ids, input_index, target_loc):
+    """Runs the encoder on the batch, then applies the LM head only at the
+    target locations of the inputs (not at every position).
+    Returns: a (readouts, vocab) tensor of log probabilities"""
+    hidden = self.model.base_model(input_ids)[0]
+    hidden = hidden[torch.as_tensor(input_index), torch.as_tensor(target_loc)]
+    return F.log_softmax(self.model.pred_layer(hidden)[0], -1)
+
+  def _log_targets(self, batch):
+    outputs = self._log_softmax_at_target(
+      batch['input_ids'].to(self.device), batch['input_index'], batch['target_loc'])
+    # the token id we need to predict, this belongs to target span
+    target_id = torch.as_tensor(batch['target_id'], device=self.device)
+    return outputs.gather(1, target_id[:, None])[:, 0]
 
   def make_subword_lists(self, ptb_tokenlist, add_special_tokens=False):
     '''
@@ -0,0 +1,96 @@
+"""
+Persistent store of the log_p matrices computed for each sentence
+(log p(w_i | c \\ w_j), from which PMI matrices are computed), so that
+sentences can be re-scored without running the language model again.
+-
+Layout of the store directory:
+  log_p.bin    all matrices (float64), appended one after another
+  index.jsonl  one line per matrix: its key, and offset and size in log_p.bin
+"""
+
+import os
+import json
+import fcntl
+import hashlib
+import numpy as np
+
+class LogPStore:
+  """
+  Append-only store of log_p matrices, keyed by a hash of what determines them
+  (the estimator, the sentence, its padding, and whether special tokens are added).
+  Matrices are read from a memory map of the data file.
+  Several processes can add to the same store (appends are done under a file lock).
+  """
+  def __init__(self, store_dir):
+    self.store_dir = store_dir
+    os.makedirs(store_dir, exist_ok=True)
+    self.data_path = os.path.join(store_dir, 'log_p.bin')
+    self.index_path = os.path.join(store_dir, 'index.jsonl')
+    for path in [self.data_path, self.index_path]:
+      open(path, 'ab').close()
+    self.index = {}
+    self._end = 0 # end (in float64 entries) of the last indexed matrix
+    self._index_read = 0 # bytes of the index file read so far
+    self._data = None
+    self._read_index()
+
+  @staticmethod
+  def key(estimator, ptb_tokenlist, pad_left=None, pad_right=None, add_special_tokens=True):
+    '''the key of the log_p matrix of a sentence, for the given estimator
+    (as given by languagemodel.store_key)'''
+    content = json.dumps([estimator, list(ptb_tokenlist), list(pad_left or []),
+                          list(pad_right or []), add_special_tokens])
+    return hashlib.sha256(content.encode()).hexdigest()
+
+  def _read_index(self):
+    '''reads lines added to the index file (by any process) since last read'''
+    with open(self.index_path, 'rb') as index_file:
+      index_file.seek(self._index_read)
+      for line in index_file:
+        if not line.endswith(b'\n'):
+          break # (being written)
+        self._index_read += len(line)
+        entry = json.loads(line)
+        self.index[entry['key']] = (entry['offset'], entry['n'])
+        self._end = max(self._end, entry['offset'] + entry['n']**2)
+
+  def __contains__(self, key):
+    if key not in self.index:
+      self._read_index()
+    return key in self.index
+
+  def __len__(self):
+    self._read_index()
+    return len(self.index)
+
+  def get(self, key):
+    '''returns: the log_p matrix for key, or None if it is not in the store'''
+    if key not in self:
+      return None
+    offset, n = self.index[key]
+    if self._data is None or len(self._data) < offset + n*n:
+      self._data = np.memmap(self.data_path, dtype=np.float64, mode='r', shape=(self._end,))
+    return np.array(self._data[offset:offset + n*n]).reshape(n, n)
+
+  def put(self, key, log_p):
+    '''appends the log_p matrix for key (unless it is already in the store)'''
+    with open(self.index_path, 'a') as index_file:
+      fcntl.flock(index_file, fcntl.LOCK_EX)
+      try:
+        self._read_index()
+        if key in self.index:
+          return
+        offset = self._end
+        with open(self.data_path, 'r+b') as data_file:
+          # (drops anything written after the last indexed matrix, by a process that crashed)
+          data_file.truncate(offset * 8)
+          data_file.seek(offset * 8)
+          data_file.write(np.ascontiguousarray(log_p, dtype=np.float64).tobytes())
+          data_file.flush()
+          os.fsync(data_file.fileno())
+        index_file.write(json.dumps({'key': key, 'offset': int(offset), 'n': len(log_p)}) + '\n')
+        index_file.flush()
+        os.fsync(index_file.fileno())
+      finally:
+        fcntl.flock(index_file, fcntl.LOCK_UN)
+    self._read_index()
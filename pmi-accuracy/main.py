@@ -1,4 +1,10 @@
 import os
+import json
+import heapq
+import multiprocessing
+import queue
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 import numpy as np
 import pandas as pd
@@ -14,6 +20,9 @@ import torch
 import task
 import parser
 import languagemodel
+import logpstore
+import workqueue
+import merge_shards
 
 # Data input
 def generate_lines_for_sent(lines):
@@ -66,52 +75,49 @@ def load_conll_dataset(filepath, observation_class):
   return observations
 
 # Running and reporting
-def score_observation(observation, pmi_matrix):
-  # Get gold edges distances tensor from conllx file (note 'mst' will always give projective gold edges)
+def score_observation(observation, pmi_matrix, max_pmi_distance=None):
+  # Get gold edges distances tensor from conllx file (note a min spanning tree of it will always give projective gold edges)
   gold_dist_matrix = task.ParseDistanceTask.labels(observation)
-  gold_edges = parser.DepParse(
-    'mst', gold_dist_matrix, observation.sentence).tree(
-        symmetrize_method='none',
-        maximum_spanning_tree=False)
-
   # Make linear-order baseline distances tensor
   linear_dist_matrix = task.LinearBaselineTask.labels(observation)
-  baseline_linear_edges = parser.DepParse(
-    'mst', linear_dist_matrix, observation.sentence).tree(
-        symmetrize_method='none',
-        maximum_spanning_tree=False)
-
   # Make random baseline distances tensor
   random_dist_matrix = task.RandomBaselineTask.labels(observation)
-  baseline_random_nonproj_edges = parser.DepParse(
-    'mst', random_dist_matrix, observation.sentence).tree(
-        symmetrize_method='none',
-        maximum_spanning_tree=False)
-  baseline_random_proj_edges = parser.DepParse(
-    'projective', random_dist_matrix, observation.sentence).tree(
-        symmetrize_method='none',
-        maximum_spanning_tree=True)
-
-  # Instantiate a parser.DepParse object, with the parsetype 'mst', to get pmi mst parse
-  mstparser = parser.DepParse('mst', pmi_matrix, observation.sentence)
-  pmi_edges = {}
-  symmetrize_methods = ['sum', 'triu', 'tril', 'none']
-  for symmetrize_method in symmetrize_methods:
-    pmi_edges[symmetrize_method] = mstparser.tree(symmetrize_method=symmetrize_method)
 
-  # Instantiate a parser.DepParse object, with parsetype 'projective', to get pmi projective parse
-  projparser = parser.DepParse('projective', pmi_matrix, observation.sentence)
-  pmi_edges_proj = {}
-  for symmetrize_method in symmetrize_methods:
-    # note, with Eisner's, symmetrize_method='none' basically gets a directed parse
-    pmi_edges_proj[symmetrize_method] = projparser.tree(symmetrize_method=symmetrize_method)
-
-  scorer = parser.Accuracy(gold_edges)
+  # Spanning trees (min for the distances, max for each symmetrize_method of pmi),
+  # decoded in one batch
+  symmetrize_methods = ['sum', 'triu', 'tril', 'none']
+  punctuation = [word in parser.EXCLUDED_PUNCTUATION for word in observation.sentence]
+  gold_edges, baseline_linear_edges, baseline_random_nonproj_edges, *mst_trees = parser.DepParse.prims_batch(
+    [gold_dist_matrix, linear_dist_matrix, random_dist_matrix]
+    + [parser.DepParse.symmetrize(pmi_matrix, method) for method in symmetrize_methods],
+    excluded=[punctuation] * (3 + len(symmetrize_methods)),
+    maximum_spanning_tree=[False] * 3 + [True] * len(symmetrize_methods))
+  pmi_edges = dict(zip(symmetrize_methods, mst_trees))
+
+  # Projective parses with Eisner's, for each symmetrize_method and the random baseline,
+  # decoded in one batch
+  # note, with Eisner's, symmetrize_method='none' basically gets a directed parse
+  *proj_trees, baseline_random_proj_edges = parser.DepParse.eisners_batch(
+    [parser.DepParse.symmetrize(pmi_matrix, method) for method in symmetrize_methods]
+    + [random_dist_matrix], [observation.sentence] * (len(symmetrize_methods) + 1))
+  pmi_edges_proj = dict(zip(symmetrize_methods, proj_trees))
+
+  # Directed parse (maximum spanning arborescence) of the raw pmi matrix, matrix[head][dep]
+  pmi_heads = parser.DepParse.arborescence(pmi_matrix, observation.sentence)
+  # gold head of each word (0-indexed, -1 for the root), None for punctuation
+  gold_heads = [None if word in parser.EXCLUDED_PUNCTUATION or head == '_' else int(head) - 1
+                for word, head in zip(observation.sentence, observation.head_indices)]
+
+  scorer = parser.Accuracy(gold_edges, gold_heads=gold_heads)
 
   scores = {}
   scores['sentence_length'] = len(observation.sentence)
   scores['number_edges'] = len(gold_edges)
   scores['gold_edges'] = gold_edges
+  if max_pmi_distance is not None:
+    # gold arcs between words too far apart to have a PMI estimate
+    scores['gold_edges_outside_window'] = sum(
+      abs(i - j) > max_pmi_distance for i, j in gold_edges)
   scores['baseline_linear'] = scorer.uuas(baseline_linear_edges)
   scores['baseline_random_nonproj'] = scorer.uuas(baseline_random_nonproj_edges)
   scores['baseline_random_proj'] = scorer.uuas(baseline_random_proj_edges)
@@ -125,6 +131,9 @@ def score_observation(observation, pmi_matrix):
   for symmetrize_method in symmetrize_methods:
     scores['nonproj']['uuas'][symmetrize_method] = scorer.uuas(pmi_edges[symmetrize_method])
     scores['projective']['uuas'][symmetrize_method] = scorer.uuas(pmi_edges_proj[symmetrize_method])
+  scores['directed'] = {}
+  scores['directed']['heads'] = pmi_heads
+  scores['directed']['uas'] = scorer.uas(pmi_heads)
 
   return scores
 
@@ -275,63 +284,308 @@ def get_padding(i, observations, threshold):
         print(f"|\t\ttruncating sentence {index} at length {excessive}")
   return prepadding, postpadding
 
+def score_sentence(
+  i, obs, pmi_matrix, pseudo_loglik, n_obs, write_wordpair_data=False, verbose=False,
+  max_pmi_distance=None):
+  '''get scores for a single observation, given its estimates
+  returns: scores, and the wordpair dataframe (None if not written)'''
+  print(f'_______________\n--> Observation {i} of {n_obs}\n')
+  if verbose:
+    obs_df = pd.DataFrame(obs).T
+    obs_df.columns = CONLL_COLS
+    print(obs_df.loc[:, ['index', 'sentence', 'xpos_sentence', 'head_indices', 'governance_relations']],
+          "\n", sep='')
+
+  # calculate score
+  scores = score_observation(obs, pmi_matrix, max_pmi_distance=max_pmi_distance)
+
+  wordpair_df = None
+  if write_wordpair_data:
+    predictors = PredictorClass(obs, pmi_matrix)
+    if predictors.includesentence:
+      symmetrize_methods = ['sum', 'triu', 'tril', 'none']
+      for symmetrize_method in symmetrize_methods:
+        predictors.add_pmi_edges(f'pmi_edge_{symmetrize_method}',
+                                 scores['projective']['edges'][symmetrize_method])
+      predictors.df.insert(0, 'sentence_index', i)
+      wordpair_df = predictors.df
+    # with pd.option_context('display.max_rows', None, 'display.max_columns', None):
+    print(predictors.df)
+
+  scores['pseudo_loglik'] = pseudo_loglik
+  print(f"linear   {scores['baseline_linear']}")
+  print(f"random   \n\tnonproj   {scores['baseline_random_nonproj']}\n\tprojective {scores['baseline_random_proj']}")
+  print(f"nonproj  {scores['nonproj']['uuas']}")
+  print(f"proj     {scores['projective']['uuas']}")
+  print(f"directed {scores['directed']['uas']}\n")
+  return scores, wordpair_df
+
 def score(
   observations, padlen=0, n_obs='all', write_wordpair_data=False,
-  save=False, verbose=False):
-  '''get estimates get scores for n (default all) observations'''
+  save=False, verbose=False, pool_size=1, workers=1, threads_per_worker=1,
+  indices=None, journal_file=None, eval_workers=0, max_pmi_distance=None):
+  '''get estimates get scores for n (default all) observations,
+  or only for those at indices, if given (a shard of the first n)
+  (the estimation tasks of pool_size sentences at a time are batched together,
+  and if workers > 1, sentences are divided among that many worker processes;
+  otherwise if eval_workers > 0, sentences are scored in a pool of that many processes
+  while the next ones are estimated)
+  the scores of each sentence are appended to journal_file as soon as they are computed'''
   all_scores = []
   if write_wordpair_data:
     wordpair_csv = RESULTS_DIR + 'wordpair_' + SUFFIX + '.csv'
-    header = True
+    # (when resuming, the file already has a header)
+    header = not os.path.isfile(wordpair_csv) or os.path.getsize(wordpair_csv) == 0
 
   if n_obs == 'all':
     n_obs = len(observations)
-  for i, obs in enumerate(tqdm(observations[:n_obs])):
-    print(f'_______________\n--> Observation {i} of {n_obs}\n')
-    if verbose:
-      obs_df = pd.DataFrame(obs).T
-      obs_df.columns = CONLL_COLS
-      print(obs_df.loc[:, ['index', 'sentence', 'xpos_sentence', 'head_indices', 'governance_relations']],
-            "\n", sep='')
-
-    prepadding, postpadding = get_padding(i, observations, padlen)
-    # get a pmi matrix and a pseudo-logprob for the sentence
-    pmi_matrix, pseudo_loglik = MODEL.ptb_tokenlist_to_pmi_matrix(
-      obs.sentence, add_special_tokens=True, verbose=False, # might want to toggle verbosity
-      pad_left=prepadding, pad_right=postpadding)
-    # calculate score
-    scores = score_observation(obs, pmi_matrix)
-
-    if write_wordpair_data:
-      predictors = PredictorClass(obs, pmi_matrix)
-      if predictors.includesentence:
-        symmetrize_methods = ['sum', 'triu', 'tril', 'none']
-        for symmetrize_method in symmetrize_methods:
-          predictors.add_pmi_edges(f'pmi_edge_{symmetrize_method}',
-                                   scores['projective']['edges'][symmetrize_method])
-        with open(wordpair_csv, 'a') as f:
-          predictors.df.insert(0, 'sentence_index', i)
-          predictors.df.to_csv(f, mode='a', header=header, index=False, float_format='%.7f')
-      header=False
-    
-    # with pd.option_context('display.max_rows', None, 'display.max_columns', None):
-    print(predictors.df)
-
-    scores['pseudo_loglik'] = pseudo_loglik
+  if indices is None:
+    indices = list(range(n_obs))
+  if workers > 1:
+    results = score_in_workers(
+      observations, indices, workers, threads_per_worker, padlen=padlen,
+      n_obs=n_obs, write_wordpair_data=write_wordpair_data, verbose=verbose,
+      pool_size=pool_size, max_pmi_distance=max_pmi_distance)
+  else:
+    # sentences with their padding, to get a pmi matrix and a pseudo-logprob for each
+    sentences = ((observations[i].sentence, *get_padding(i, observations, padlen))
+                 for i in indices)
+    estimates = MODEL.ptb_tokenlists_to_pmi_matrices(
+      sentences, add_special_tokens=True, verbose=False, # might want to toggle verbosity
+      pool_size=pool_size)
+    if eval_workers > 0:
+      results = score_in_pool(
+        observations, zip(indices, estimates), eval_workers, n_obs=n_obs,
+        write_wordpair_data=write_wordpair_data, verbose=verbose,
+        max_pmi_distance=max_pmi_distance)
+    else:
+      results = (score_sentence(i, observations[i], pmi_matrix, pseudo_loglik, n_obs,
+                                write_wordpair_data=write_wordpair_data, verbose=verbose,
+                                max_pmi_distance=max_pmi_distance)
+                 for i, (pmi_matrix, pseudo_loglik) in zip(tqdm(indices), estimates))
+  journal = open(journal_file, 'a') if journal_file else None
+  for k, (scores, wordpair_df) in enumerate(results):
+    i = indices[k]
+    if wordpair_df is not None:
+      with open(wordpair_csv, 'a') as f:
+        wordpair_df.to_csv(f, mode='a', header=header, index=False, float_format='%.7f')
+      header = False
+    if journal:
+      # (after the wordpair data, so that a sentence in the journal is complete)
+      write_to_journal(journal, i, scores)
     all_scores.append(scores)
-    print(f"linear   {scores['baseline_linear']}")
-    print(f"random   \n\tnonproj   {scores['baseline_random_nonproj']}\n\tprojective {scores['baseline_random_proj']}")
-    print(f"nonproj  {scores['nonproj']['uuas']}")
-    print(f"proj     {scores['projective']['uuas']}\n")
+  if journal:
+    journal.close()
   print("all scores computed.")
   return all_scores
 
+def write_to_journal(journal, i, scores):
+  '''appends the scores of sentence i to the journal (a jsonl file), durably'''
+  journal.write(json.dumps({'sentence_index': i, 'scores': scores},
+                           default=lambda x: x.item()) + '\n')
+  journal.flush()
+  os.fsync(journal.fileno())
+
+def read_journal(journal_file):
+  '''
+  reads the scores of the sentences finished so far from the journal
+  (ignoring an incomplete last line, if it was being written during a crash)
+  returns: dict of sentence index to scores (as returned by score_observation)
+  '''
+  finished = {}
+  if not os.path.isfile(journal_file):
+    return finished
+  with open(journal_file) as journal:
+    for line in journal:
+      try:
+        entry = json.loads(line)
+      except json.JSONDecodeError:
+        continue
+      scores = entry['scores']
+      # json turns the edge tuples into lists
+      scores['gold_edges'] = [tuple(edge) for edge in scores['gold_edges']]
+      for parsetype in ['projective', 'nonproj']:
+        for symmetrize_method, edges in scores[parsetype]['edges'].items():
+          scores[parsetype]['edges'][symmetrize_method] = [tuple(edge) for edge in edges]
+      finished[entry['sentence_index']] = scores
+  return finished
+
+def truncate_incomplete_line(path):
+  '''removes an incomplete last line from a file (being written during a crash),
+  so that more lines can be appended'''
+  if not os.path.isfile(path):
+    return
+  with open(path, 'rb+') as f:
+    text = f.read()
+    f.truncate(text.rfind(b'\n')+1)
+
+def truncate_wordpair_csv(wordpair_csv, finished):
+  '''when resuming, removes the wordpair data of sentences which are not finished
+  (written just before a crash, but not in the journal)'''
+  truncate_incomplete_line(wordpair_csv)
+  if not os.path.isfile(wordpair_csv) or os.path.getsize(wordpair_csv) == 0:
+    return
+  wordpair_df = pd.read_csv(wordpair_csv, dtype=str, keep_default_na=False)
+  wordpair_df = wordpair_df[wordpair_df.sentence_index.astype(int).isin(finished)]
+  wordpair_df.to_csv(wordpair_csv, index=False)
+
+def _init_eval_worker(observations):
+  '''runs in each (forked) process of the pool of score_in_pool'''
+  global EVAL_OBSERVATIONS
+  # (passed on by fork, as the observation class cannot be pickled)
+  EVAL_OBSERVATIONS = observations
+  # (otherwise every process would draw the same random baselines)
+  torch.seed()
+
+def _eval_worker_score(i, pmi_matrix, pseudo_loglik, **kwargs):
+  return score_sentence(i, EVAL_OBSERVATIONS[i], pmi_matrix, pseudo_loglik, **kwargs)
+
+def score_in_pool(observations, estimates, eval_workers, max_pending=None, **kwargs):
+  '''
+  scores sentences in a pool of eval_workers processes, as their estimates come in
+  (so that estimation, in this process, does not wait for scoring).
+  At most max_pending (default 4 per worker) sentences wait to be scored:
+  beyond that, estimation waits for scoring.
+  input: estimates: iterable of (index, (pmi_matrix, pseudo_loglik))
+  yields: the (scores, wordpair_df) of score_sentence for each, in order
+  '''
+  max_pending = max_pending or 4 * eval_workers
+  pending = deque()
+  with ProcessPoolExecutor(
+      eval_workers, mp_context=multiprocessing.get_context('fork'),
+      initializer=_init_eval_worker, initargs=(observations,)) as pool:
+    for i, (pmi_matrix, pseudo_loglik) in tqdm(estimates):
+      pending.append(pool.submit(_eval_worker_score, i, pmi_matrix, pseudo_loglik, **kwargs))
+      while len(pending) > max_pending:
+        yield pending.popleft().result()
+    while pending:
+      yield pending.popleft().result()
+
+def estimate(observations, indices, padlen=0, pool_size=1):
+  '''estimates the observations at indices (and nothing else),
+  to be scored later from the store'''
+  sentences = ((observations[i].sentence, *get_padding(i, observations, padlen))
+               for i in indices)
+  for _ in tqdm(MODEL.ptb_tokenlists_to_pmi_matrices(
+      sentences, add_special_tokens=True, verbose=False, pool_size=pool_size),
+                total=len(indices)):
+    pass
+  print("all estimates computed.")
+
+def score_pseudo_logliks(observations, indices, file, padlen=0, pool_size=1):
+  '''gets only the pseudo log likelihood of the observations at indices
+  (running only the diagonal estimation tasks), and writes them to a csv file'''
+  sentences = ((observations[i].sentence, *get_padding(i, observations, padlen))
+               for i in indices)
+  pseudo_logliks = MODEL.ptb_tokenlists_to_pseudo_logliks(
+    sentences, add_special_tokens=True, verbose=False, pool_size=pool_size)
+  pll_df = pd.DataFrame({
+    'sentence_length': [len(observations[i].sentence) for i in indices],
+    'pseudo_loglik': list(tqdm(pseudo_logliks, total=len(indices))),
+    'sentence': [' '.join(observations[i].sentence) for i in indices]}, index=indices)
+  pll_df.to_csv(path_or_buf=file, index_label='sentence_index')
+  print(f'pseudo log likelihoods of {len(indices)} sentences written to {file}')
+
+def estimation_cost(observation, padlen=0):
+  '''rough cost of estimating the PMI matrix of an observation:
+  number of tasks (~n^2) times input length (at least padlen, with padding)'''
+  n = len(observation.sentence)
+  return n * n * max(n, padlen)
+
+def assign_by_cost(indices, costs, n_parts):
+  '''
+  divides indices into n_parts with balanced total cost
+  (greedily: the most costly first, each to the part with least total cost so far)
+  returns: list of n_parts lists of indices, each in increasing order
+  '''
+  parts = [[] for _ in range(n_parts)]
+  totals = [(0, part) for part in range(n_parts)]
+  for index, cost in sorted(zip(indices, costs), key=lambda x: (-x[1], x[0])):
+    total, part = heapq.heappop(totals)
+    parts[part].append(index)
+    heapq.heappush(totals, (total + cost, part))
+  return [sorted(part) for part in parts]
+
+def shard_indices(observations, n_obs, shard, n_shards, padlen=0):
+  '''the indices of the first n_obs observations in shard (of n_shards),
+  with shards balanced by estimated cost'''
+  indices = list(range(n_obs))
+  costs = [estimation_cost(observations[i], padlen) for i in indices]
+  return assign_by_cost(indices, costs, n_shards)[shard]
+
+def _score_worker(indices, observations, padlen, n_threads, results, **kwargs):
+  '''runs in a forked worker process: scores the observations at indices,
+  putting (index, result) on the results queue, and finally (None, timing)'''
+  torch.set_num_threads(n_threads)
+  # (otherwise every worker would draw the same random baselines)
+  torch.seed()
+  MODEL.after_fork()
+  timing = dict(MODEL.timing)
+  sentences = ((observations[i].sentence, *get_padding(i, observations, padlen))
+               for i in indices)
+  estimates = MODEL.ptb_tokenlists_to_pmi_matrices(
+    sentences, add_special_tokens=True, verbose=False, pool_size=kwargs.pop('pool_size'))
+  for i, (pmi_matrix, pseudo_loglik) in zip(indices, estimates):
+    results.put((i, score_sentence(i, observations[i], pmi_matrix, pseudo_loglik, **kwargs)))
+  results.put((None, {key: MODEL.timing[key] - timing[key] for key in timing}))
+
+def score_in_workers(
+  observations, indices, workers, threads_per_worker, padlen=0, **kwargs):
+  '''
+  scores the observations at indices in worker processes forked from this one
+  (so they share MODEL's weights, copy-on-write), each with threads_per_worker threads.
+  Observations are divided among workers by estimated cost.
+  yields: the (scores, wordpair_df) of score_sentence for each index, in order
+  '''
+  costs = [estimation_cost(observations[i], padlen) for i in indices]
+  context = multiprocessing.get_context('fork')
+  results = context.Queue()
+  processes = [context.Process(
+    target=_score_worker, args=(part, observations, padlen, threads_per_worker, results),
+    kwargs=kwargs, daemon=True) for part in assign_by_cost(indices, costs, workers) if part]
+  for process in processes:
+    process.start()
+  print(f'Scoring {len(indices)} sentences with {len(processes)} workers '
+        f'({threads_per_worker} threads each).')
+
+  finished = {}
+  timings = []
+  position = 0
+  progress = tqdm(total=len(indices))
+  while position < len(indices) or len(timings) < len(processes):
+    try:
+      i, result = results.get(timeout=10)
+    except queue.Empty:
+      if any(process.exitcode not in (None, 0) for process in processes):
+        for process in processes:
+          process.terminate()
+        raise RuntimeError('A worker process failed.')
+      continue
+    if i is None:
+      timings.append(result)
+      continue
+    finished[i] = result
+    # results are passed on in order, as soon as they are available
+    while position < len(indices) and indices[position] in finished:
+      yield finished.pop(indices[position])
+      position += 1
+      progress.update(1)
+  progress.close()
+  for process in processes:
+    process.join()
+  # workers run in parallel, so the time taken is that of the slowest
+  MODEL.timing['sentences'] += sum(timing['sentences'] for timing in timings)
+  MODEL.timing['tasks'] += sum(timing['tasks'] for timing in timings)
+  MODEL.timing['seconds'] += max((timing['seconds'] for timing in timings), default=0.)
+
 def print_means_to_file(all_scores, file):
   mean_linear = np.nanmean([scores['baseline_linear'] for scores in all_scores])
   mean_random_nonproj = np.nanmean([scores['baseline_random_nonproj'] for scores in all_scores])
   mean_random_proj = np.nanmean([scores['baseline_random_proj'] for scores in all_scores])
   mean_nonproj = {symmethod:np.nanmean([scores['nonproj']['uuas'][symmethod] for scores in all_scores]) for symmethod in ['sum', 'triu', 'tril', 'none']}
   mean_proj = {symmethod:np.nanmean([scores['projective']['uuas'][symmethod] for scores in all_scores]) for symmethod in ['sum', 'triu', 'tril', 'none']}
+  mean_directed = np.nanmean([scores['directed']['uas'] for scores in all_scores
+                              if 'directed' in scores])
   
   with open(file, mode='a') as infofile:
     infofile.write("=========\nmean uuas values\n")
@@ -339,6 +593,116 @@ def print_means_to_file(all_scores, file):
     infofile.write(f'random :\n\t\tnonproj   {mean_random_nonproj:.3}\n\tprojective {mean_random_proj:.3}\n')
     infofile.write(f'nonproj: { {k:round(v,3) for k, v in mean_nonproj.items()}}\n')
     infofile.write(f'proj   : { {k:round(v,3) for k, v in mean_proj.items()}}\n')
+    infofile.write(f'directed (uas): {mean_directed:.3}\n')
+    if all_scores and 'gold_edges_outside_window' in all_scores[0]:
+      n_outside = sum(scores['gold_edges_outside_window'] for scores in all_scores)
+      n_gold = sum(scores['number_edges'] for scores in all_scores)
+      infofile.write(f'gold arcs outside max_pmi_distance: {n_outside}/{n_gold} '
+                     f'({n_outside/max(n_gold, 1):.2%})\n')
+
+def check_against_fp32(observations, n_check, padlen=0, pool_size=1):
+  '''
+  compares the PMI estimates of MODEL (at reduced precision, or quantized)
+  with those of the full precision (fp32) model, on the first n_check observations,
+  both directly and by the agreement of the resulting trees
+  returns: dict of summary statistics of the drift, and the throughput of each
+  '''
+  sentences = [(obs.sentence, *get_padding(i, observations, padlen))
+               for i, obs in enumerate(observations[:n_check])]
+  if MODEL.backend == 'torch':
+    # same weights, so it is enough to run MODEL itself at fp32
+    reference_model = MODEL
+  else:
+    reference_model = type(MODEL)(
+      MODEL.device, MODEL.model_spec, MODEL.batchsize, max_tokens=MODEL.max_tokens,
+      excluded_words=MODEL.excluded_words, max_pmi_distance=MODEL.max_pmi_distance)
+  precision = MODEL.precision
+  # (estimates are made again, not taken from the store)
+  store = MODEL.store
+  MODEL.store = None
+
+  def estimate_timed(model):
+    timing = dict(model.timing)
+    estimates = list(model.ptb_tokenlists_to_pmi_matrices(
+      sentences, verbose=False, pool_size=pool_size))
+    tasks_per_second = ((model.timing['tasks'] - timing['tasks'])
+                        / (model.timing['seconds'] - timing['seconds']))
+    return estimates, tasks_per_second
+
+  try:
+    estimates, tasks_per_second = estimate_timed(MODEL)
+    reference_model.precision = 'fp32'
+    reference, reference_tasks_per_second = estimate_timed(reference_model)
+  finally:
+    MODEL.precision = precision
+    MODEL.store = store
+
+  pmi_diffs = np.concatenate([np.abs(pmi - pmi_ref).ravel()
+                              for (pmi, _), (pmi_ref, _) in zip(estimates, reference)])
+  pll_diffs = np.array([abs(pll - pll_ref)
+                        for (_, pll), (_, pll_ref) in zip(estimates, reference)])
+  # agreement of the resulting trees, and uuas of each
+  agreement, uuas, uuas_ref = [], [], []
+  for obs, (pmi, _), (pmi_ref, _) in zip(observations, estimates, reference):
+    scores = score_observation(obs, pmi)
+    scores_ref = score_observation(obs, pmi_ref)
+    for parsetype in ['nonproj', 'projective']:
+      for symmetrize_method in ['sum', 'triu', 'tril', 'none']:
+        edges = parser.Accuracy(scores_ref[parsetype]['edges'][symmetrize_method])
+        agreement.append(edges.uuas(scores[parsetype]['edges'][symmetrize_method]))
+        uuas.append(scores[parsetype]['uuas'][symmetrize_method])
+        uuas_ref.append(scores_ref[parsetype]['uuas'][symmetrize_method])
+  return {'estimator': f'{MODEL.backend} {precision}',
+          'n_sentences': len(sentences),
+          'pmi_mean_abs_diff': np.nanmean(pmi_diffs),
+          'pmi_max_abs_diff': np.nanmax(pmi_diffs),
+          'pseudo_loglik_mean_abs_diff': np.nanmean(pll_diffs),
+          'tree_agreement': np.nanmean(agreement),
+          'mean_uuas': np.nanmean(uuas),
+          'mean_uuas_fp32': np.nanmean(uuas_ref),
+          'tasks_per_second': tasks_per_second,
+          'tasks_per_second_fp32': reference_tasks_per_second}
+
+def print_fp32_check_to_file(check, file):
+  with open(file, mode='a') as infofile:
+    infofile.write(f"=========\n{check['estimator']} vs torch fp32 on {check['n_sentences']} sentences\n")
+    for key, value in check.items():
+      if key not in ('estimator', 'n_sentences'):
+        infofile.write(f'{key}: {value:.3}\n')
+
+def print_throughput_to_file(timing, file):
+  with open(file, mode='a') as infofile:
+    infofile.write("=========\nestimation throughput\n")
+    infofile.write(f"{timing['sentences']} sentences, {timing['tasks']} tasks in {timing['seconds']:.1f}s\n")
+    if timing['seconds'] > 0:
+      infofile.write(f"sentences/s: {timing['sentences']/timing['seconds']:.3}\n")
+      infofile.write(f"tasks/s    : {timing['tasks']/timing['seconds']:.1f}\n")
+
+def print_args_to_file(cli_args, file):
+  print('Running with CLI_ARGS:')
+  with open(file, mode='w') as infofile:
+    for arg, value in sorted(vars(cli_args).items()):
+      argvalue = f"{arg}:\t{value}"
+      infofile.write(argvalue+'\n')
+      print(argvalue)
+
+def print_scores_to_csv(all_scores, file, indices=None):
+  df = pd.json_normalize(all_scores, sep='.')
+  if indices is not None:
+    df.index = indices
+  df.to_csv(path_or_buf=file, index_label='sentence_index')
+
+def work_queue_chunks(observations, n_obs, chunk_size, padlen=0):
+  '''
+  splits the first n_obs observations into chunks of consecutive indices for a work queue
+  returns: the chunks, and the order in which to claim them
+    (most costly first, so that the last ones to finish are short)
+  '''
+  chunks = [list(range(start, min(start + chunk_size, n_obs)))
+            for start in range(0, n_obs, chunk_size)]
+  costs = [sum(estimation_cost(observations[i], padlen) for i in chunk) for chunk in chunks]
+  order = sorted(range(len(chunks)), key=lambda k: (-costs[k], k))
+  return chunks, order
 
 if __name__ == '__main__':
   ARGP = ArgumentParser()
@@ -356,9 +720,79 @@ if __name__ == '__main__':
   # ARGP.add_argument('--save_matrices', action='store_true',
   #                   help='to save PMI matrices to disk.')
   ARGP.add_argument('--batch_size', default=32, type=int)
+  ARGP.add_argument('--max_tokens', default=None, type=int,
+                    help='''(int) size batches by total number of input tokens
+                    (batch x sequence length) instead of by --batch_size''')
+  ARGP.add_argument('--precision', default='fp32', choices=['fp32', 'bf16'],
+                    help='''precision to run the model at ('bf16' uses bfloat16 autocast)''')
+  ARGP.add_argument('--backend', default='torch', choices=['torch', 'int8', 'onnx'],
+                    help=''''torch' to run the pretrained model as is, 'int8' to run
+                    it with dynamic int8 quantization of its Linear layers (cpu and fp32 only),
+                    'onnx' to export it to onnx and run it with ONNX Runtime (cpu and fp32 only)''')
+  ARGP.add_argument('--onnx_dir', default='onnx-models/',
+                    help='path/to/directory/ where the models exported to onnx are kept')
+  ARGP.add_argument('--precision_check', default=20, type=int,
+                    help='''(int) number of sentences on which to record how far
+                    the PMI estimates drift from the torch fp32 ones
+                    (if --precision or --backend are not the default)''')
   ARGP.add_argument('--pad', default=0, type=int,
                     help='(int) pad sentences to be at least this long')
+  ARGP.add_argument('--workers', default=1, type=int,
+                    help='''(int) number of worker processes to divide sentences among
+                    (forked after loading the model, so they share its weights;
+                    these run on cpu)''')
+  ARGP.add_argument('--threads_per_worker', default=None, type=int,
+                    help='''(int) number of threads for each worker process
+                    (default: the available threads divided by --workers)''')
+  ARGP.add_argument('--shard', default=None,
+                    help='''i/N: score only the i-th of N shards of the sentences
+                    (0 <= i < N; shards are balanced by estimated cost).
+                    Combine the results of all shards with merge_shards.py''')
+  ARGP.add_argument('--queue_dir', default=None,
+                    help='''path/to/queue/directory/ (on a filesystem shared by all workers):
+                    run as one of any number of workers taking chunks of sentences
+                    from a work queue there. The last worker to finish merges
+                    the results into a new directory in --results_dir''')
+  ARGP.add_argument('--chunk_size', default=8, type=int,
+                    help='(int) number of sentences per chunk of the work queue')
+  ARGP.add_argument('--claim_timeout', default=600, type=float,
+                    help='''(float) seconds after which a claim on a chunk of the
+                    work queue that has not been refreshed (by a worker that crashed)
+                    can be taken over''')
+  ARGP.add_argument('--resume', default=None,
+                    help='''path/to/results/directory/ of an interrupted run, to continue it
+                    (with the same other arguments). Sentences already in its journal
+                    are not scored again''')
+  ARGP.add_argument('--store', default=None,
+                    help='''path/to/store/directory/ where the estimates (log_p matrices)
+                    of every sentence are kept. Sentences already in the store are not
+                    estimated again (and if all are, the model is not even loaded)''')
+  ARGP.add_argument('--mode', default='pmi', choices=['pmi', 'pll'],
+                    help=''''pmi' (default) estimates PMI and scores the trees,
+                    'pll' only gets the pseudo log likelihood of each sentence''')
+  ARGP.add_argument('--stage', default='both', choices=['both', 'estimate', 'evaluate'],
+                    help=''''estimate' only estimates, adding to --store,
+                    'evaluate' only scores, from the estimates in --store,
+                    'both' (default) does both''')
+  ARGP.add_argument('--eval_workers', default=0, type=int,
+                    help='''(int) number of processes to score sentences in,
+                    while the next sentences are estimated (with --workers 1)''')
+  ARGP.add_argument('--skip_punctuation', action='store_true',
+                    help='''do not estimate PMI for pairs with a punctuation word
+                    (these are excluded from the trees anyway)''')
+  ARGP.add_argument('--max_pmi_distance', type=int,
+                    help='''(int) only estimate PMI for pairs of words at most this many
+                    words apart (the others are missing, so can't be arcs)''')
+  ARGP.add_argument('--pool_size', default=64, type=int,
+                    help='''(int) number of sentences whose estimation tasks
+                    are pooled into shared batches (grouped by input length)''')
   CLI_ARGS = ARGP.parse_args()
+  if CLI_ARGS.stage != 'both' and not CLI_ARGS.store:
+    ARGP.error(f'--stage {CLI_ARGS.stage} needs a --store.')
+  if CLI_ARGS.stage != 'both' and CLI_ARGS.queue_dir:
+    ARGP.error(f'--stage {CLI_ARGS.stage} can not be used with --queue_dir.')
+  if CLI_ARGS.mode == 'pll' and (CLI_ARGS.queue_dir or CLI_ARGS.stage != 'both'):
+    ARGP.error('--mode pll runs on its own (no --queue_dir or --stage).')
 
   SPEC_STRING = str(CLI_ARGS.model_spec)
 
@@ -370,19 +804,31 @@ if __name__ == '__main__':
   DATE_SUFFIX = f'{NOW.year}-{NOW.month:02}-{NOW.day:02}-{NOW.hour:02}-{NOW.minute:02}'
   SPEC_SUFFIX = SPEC_STRING+'('+str(CLI_ARGS.n_observations)+')' if CLI_ARGS.n_observations != 'all' else SPEC_STRING
   SPEC_SUFFIX += '_pad'+str(CLI_ARGS.pad)
+  if CLI_ARGS.shard:
+    SHARD, N_SHARDS = (int(x) for x in CLI_ARGS.shard.split('/'))
+    if not 0 <= SHARD < N_SHARDS:
+      raise ValueError(f'Shard {CLI_ARGS.shard} does not exist.')
+    SPEC_SUFFIX += f'_shard{SHARD}of{N_SHARDS}'
   SUFFIX = SPEC_SUFFIX + '_' + DATE_SUFFIX
-  RESULTS_DIR = os.path.join(CLI_ARGS.results_dir, SUFFIX + '/')
-  os.makedirs(RESULTS_DIR, exist_ok=True)
-  print(f'RESULTS_DIR: {RESULTS_DIR}\n')
-
-  print('Running with CLI_ARGS:')
-  with open(RESULTS_DIR+'info.txt', mode='w') as infofile:
-    for arg, value in sorted(vars(CLI_ARGS).items()):
-      argvalue = f"{arg}:\t{value}"
-      infofile.write(argvalue+'\n')
-      print(argvalue)
+  if CLI_ARGS.queue_dir:
+    # results go to the queue directory, chunk by chunk
+    print(f'QUEUE_DIR: {CLI_ARGS.queue_dir}\n')
+  elif CLI_ARGS.resume:
+    RESULTS_DIR = os.path.join(CLI_ARGS.resume, '')
+    SUFFIX = os.path.basename(os.path.normpath(RESULTS_DIR))
+    print(f'RESULTS_DIR: {RESULTS_DIR} (resuming)\n')
+  else:
+    RESULTS_DIR = os.path.join(CLI_ARGS.results_dir, SUFFIX + '/')
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    print(f'RESULTS_DIR: {RESULTS_DIR}\n')
+    print_args_to_file(CLI_ARGS, RESULTS_DIR+'info.txt')
 
   DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+  if CLI_ARGS.backend in ('int8', 'onnx'):
+    DEVICE = torch.device('cpu')
+  if CLI_ARGS.workers > 1:
+    # CUDA can't be used in forked worker processes
+    DEVICE = torch.device('cpu')
   print('Using device:', DEVICE)
   if DEVICE.type == 'cuda':
     print(torch.cuda.get_device_name(0))
@@ -390,20 +836,6 @@ if __name__ == '__main__':
     print('Allocated:', round(torch.cuda.memory_allocated(0)/1024**3, 1), 'GB')
     print('Cached:   ', round(torch.cuda.memory_cached(0)/1024**3, 1), 'GB')
 
-  # Instantiate the language model to use for getting estimates
-
-  if CLI_ARGS.model_spec.startswith('xlnet'):
-    MODEL_TYPE = 'xlnet'
-    MODEL = languagemodel.XLNet(DEVICE, CLI_ARGS.model_spec, CLI_ARGS.batch_size)
-  elif CLI_ARGS.model_spec.startswith('bert'):
-    MODEL_TYPE = 'bert'
-    MODEL = languagemodel.BERT(DEVICE, CLI_ARGS.model_spec, CLI_ARGS.batch_size)
-  elif CLI_ARGS.model_spec.startswith('xlm'):
-    MODEL_TYPE = 'xlm'
-    MODEL = languagemodel.XLM(DEVICE, CLI_ARGS.model_spec, CLI_ARGS.batch_size)
-  else:
-    raise ValueError(f'Model spec string {CLI_ARGS.model_spec} not recognized.')
-
   # Columns of CONLL file
   CONLL_COLS = ['index',
                 'sentence',
@@ -419,9 +851,118 @@ if __name__ == '__main__':
   ObservationClass = namedtuple("Observation", CONLL_COLS)
   OBSERVATIONS = load_conll_dataset(CLI_ARGS.conllx_file, ObservationClass)
 
-  SCORES = score(OBSERVATIONS, padlen=CLI_ARGS.pad, n_obs=N_OBS,
-                 write_wordpair_data=True, verbose=True)
-  print_means_to_file(SCORES, RESULTS_DIR+'info.txt')
-  DF = pd.json_normalize(SCORES, sep='.')
-  DF.to_csv(path_or_buf=RESULTS_DIR + 'scores_' + SUFFIX + '.csv',
-            index_label='sentence_index')
+  # Words excluded from the trees need not be estimated
+  EXCLUDED_WORDS = parser.EXCLUDED_PUNCTUATION if CLI_ARGS.skip_punctuation else None
+
+  # The sentences this run scores (with --queue_dir, any of them, chunk by chunk)
+  INDICES = list(range(len(OBSERVATIONS) if N_OBS == 'all' else N_OBS))
+  if CLI_ARGS.shard:
+    INDICES = shard_indices(
+      OBSERVATIONS, len(INDICES), SHARD, N_SHARDS, padlen=CLI_ARGS.pad)
+
+  # If all the estimates needed are in the store, the language model is not needed
+  STORE = None
+  MODEL = None
+  if CLI_ARGS.store:
+    STORE = logpstore.LogPStore(CLI_ARGS.store)
+    STORED_ESTIMATES = languagemodel.StoredEstimates(
+      STORE, CLI_ARGS.model_spec, backend=CLI_ARGS.backend, precision=CLI_ARGS.precision,
+      excluded_words=EXCLUDED_WORDS, max_pmi_distance=CLI_ARGS.max_pmi_distance)
+    if STORED_ESTIMATES.has_estimates(
+        [(OBSERVATIONS[i].sentence, *get_padding(i, OBSERVATIONS, CLI_ARGS.pad))
+         for i in INDICES]):
+      print(f'All estimates are in the store {CLI_ARGS.store}, not loading the model.')
+      MODEL = STORED_ESTIMATES
+    elif CLI_ARGS.stage == 'evaluate':
+      raise ValueError(f'Not all estimates are in the store {CLI_ARGS.store}, '
+                       'run --stage estimate first.')
+
+  # Instantiate the language model to use for getting estimates
+  if MODEL is None:
+    if CLI_ARGS.model_spec.startswith('xlnet'):
+      MODEL_TYPE = 'xlnet'
+      MODEL = languagemodel.XLNet(
+        DEVICE, CLI_ARGS.model_spec, CLI_ARGS.batch_size,
+        max_tokens=CLI_ARGS.max_tokens, precision=CLI_ARGS.precision,
+        backend=CLI_ARGS.backend, onnx_dir=CLI_ARGS.onnx_dir, store=STORE,
+        excluded_words=EXCLUDED_WORDS, max_pmi_distance=CLI_ARGS.max_pmi_distance)
+    elif CLI_ARGS.model_spec.startswith('bert'):
+      MODEL_TYPE = 'bert'
+      MODEL = languagemodel.BERT(
+        DEVICE, CLI_ARGS.model_spec, CLI_ARGS.batch_size,
+        max_tokens=CLI_ARGS.max_tokens, precision=CLI_ARGS.precision,
+        backend=CLI_ARGS.backend, onnx_dir=CLI_ARGS.onnx_dir, store=STORE,
+        excluded_words=EXCLUDED_WORDS, max_pmi_distance=CLI_ARGS.max_pmi_distance)
+    elif CLI_ARGS.model_spec.startswith('xlm'):
+      MODEL_TYPE = 'xlm'
+      MODEL = languagemodel.XLM(
+        DEVICE, CLI_ARGS.model_spec, CLI_ARGS.batch_size,
+        max_tokens=CLI_ARGS.max_tokens, precision=CLI_ARGS.precision,
+        backend=CLI_ARGS.backend, onnx_dir=CLI_ARGS.onnx_dir, store=STORE,
+        excluded_words=EXCLUDED_WORDS, max_pmi_distance=CLI_ARGS.max_pmi_distance)
+    else:
+      raise ValueError(f'Model spec string {CLI_ARGS.model_spec} not recognized.')
+
+  THREADS_PER_WORKER = CLI_ARGS.threads_per_worker
+  if THREADS_PER_WORKER is None:
+    THREADS_PER_WORKER = max(1, torch.get_num_threads() // CLI_ARGS.workers)
+  if CLI_ARGS.queue_dir:
+    # each chunk is scored like a shard, and the results merged like shards
+    CHUNKS, ORDER = work_queue_chunks(
+      OBSERVATIONS, len(OBSERVATIONS) if N_OBS == 'all' else N_OBS,
+      CLI_ARGS.chunk_size, padlen=CLI_ARGS.pad)
+    QUEUE = workqueue.WorkQueue(
+      CLI_ARGS.queue_dir, CHUNKS, claim_timeout=CLI_ARGS.claim_timeout)
+    for CHUNK_ID, INDICES, RESULTS_DIR in QUEUE.claims(order=ORDER):
+      print(f'Claimed chunk {CHUNK_ID} of {len(CHUNKS)}: sentences {INDICES}')
+      SUFFIX = SPEC_SUFFIX + f'_shard{CHUNK_ID}of{len(CHUNKS)}_' + DATE_SUFFIX
+      MODEL.timing = {'sentences': 0, 'tasks': 0, 'seconds': 0.}
+      print_args_to_file(CLI_ARGS, RESULTS_DIR+'info.txt')
+      SCORES = score(OBSERVATIONS, padlen=CLI_ARGS.pad, n_obs=N_OBS, indices=INDICES,
+                     write_wordpair_data=True, verbose=True,
+                     pool_size=CLI_ARGS.pool_size, workers=CLI_ARGS.workers,
+                     threads_per_worker=THREADS_PER_WORKER, eval_workers=CLI_ARGS.eval_workers,
+                     max_pmi_distance=CLI_ARGS.max_pmi_distance)
+      print_means_to_file(SCORES, RESULTS_DIR+'info.txt')
+      print_throughput_to_file(MODEL.timing, RESULTS_DIR+'info.txt')
+      print_scores_to_csv(SCORES, RESULTS_DIR + 'scores_' + SUFFIX + '.csv', indices=INDICES)
+    if not QUEUE.claim_merge():
+      print('Work queue finished (results merged by another worker).')
+      raise SystemExit
+    RESULTS_DIR = merge_shards.merge_shards(QUEUE.result_dirs(), CLI_ARGS.results_dir)
+  else:
+    if CLI_ARGS.stage == 'estimate':
+      estimate(OBSERVATIONS, INDICES, padlen=CLI_ARGS.pad, pool_size=CLI_ARGS.pool_size)
+      print_throughput_to_file(MODEL.timing, RESULTS_DIR+'info.txt')
+      raise SystemExit
+    if CLI_ARGS.mode == 'pll':
+      score_pseudo_logliks(OBSERVATIONS, INDICES, RESULTS_DIR + 'pll_' + SUFFIX + '.csv',
+                           padlen=CLI_ARGS.pad, pool_size=CLI_ARGS.pool_size)
+      print_throughput_to_file(MODEL.timing, RESULTS_DIR+'info.txt')
+      raise SystemExit
+    JOURNAL = RESULTS_DIR + 'journal.jsonl'
+    truncate_incomplete_line(JOURNAL)
+    FINISHED = read_journal(JOURNAL)
+    if FINISHED:
+      print(f'Resuming: {len(FINISHED)} sentences already finished.')
+    if CLI_ARGS.resume:
+      # (even with no sentence finished, rows of an unfinished one may have been written)
+      truncate_wordpair_csv(RESULTS_DIR + 'wordpair_' + SUFFIX + '.csv', FINISHED)
+    SCORES = score(OBSERVATIONS, padlen=CLI_ARGS.pad, n_obs=N_OBS,
+                   indices=[i for i in INDICES if i not in FINISHED],
+                   write_wordpair_data=True, verbose=True,
+                   pool_size=CLI_ARGS.pool_size, workers=CLI_ARGS.workers,
+                   threads_per_worker=THREADS_PER_WORKER, journal_file=JOURNAL,
+                   eval_workers=CLI_ARGS.eval_workers, max_pmi_distance=CLI_ARGS.max_pmi_distance)
+    # all scores, from the journal (finished before resuming) and from this run
+    FINISHED.update(zip([i for i in INDICES if i not in FINISHED], SCORES))
+    SCORES = [FINISHED[i] for i in INDICES]
+    print_means_to_file(SCORES, RESULTS_DIR+'info.txt')
+    print_throughput_to_file(MODEL.timing, RESULTS_DIR+'info.txt')
+    print_scores_to_csv(SCORES, RESULTS_DIR + 'scores_' + SUFFIX + '.csv', indices=INDICES)
+  if ((CLI_ARGS.precision != 'fp32' or CLI_ARGS.backend != 'torch')
+      and CLI_ARGS.precision_check > 0 and isinstance(MODEL, languagemodel.LanguageModel)):
+    FP32_CHECK = check_against_fp32(
+      OBSERVATIONS, CLI_ARGS.precision_check, padlen=CLI_ARGS.pad,
+      pool_size=CLI_ARGS.pool_size)
+    print_fp32_check_to_file(FP32_CHECK, RESULTS_DIR+'info.txt')
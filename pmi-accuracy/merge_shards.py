@@ -0,0 +1,132 @@
+"""
+Merges the results of a run split into shards (main.py --shard i/N)
+into the scores, wordpair and info files that a single run would give.
+-
+usage: python merge_shards.py results/shard0dir/ results/shard1dir/ ... [--results_dir results/]
+"""
+
+import os
+import re
+import glob
+from argparse import ArgumentParser
+
+import pandas as pd
+
+import main
+
+SHARD_PATTERN = re.compile(r'_shard(\d+)of(\d+)')
+SYMMETRIZE_METHODS = ['sum', 'triu', 'tril', 'none']
+
+def find_results(shard_dir):
+  '''
+  gets the shard number and result files of a shard's results directory
+  returns: shard, n_shards, suffix (the file suffix without shard tag),
+    and paths to scores csv, wordpair csv (or None), info.txt
+  '''
+  scores_csv, = glob.glob(os.path.join(shard_dir, 'scores_*.csv'))
+  wordpair_csv = glob.glob(os.path.join(shard_dir, 'wordpair_*.csv'))
+  shard_suffix = os.path.basename(scores_csv)[len('scores_'):-len('.csv')]
+  match = SHARD_PATTERN.search(shard_suffix)
+  if not match:
+    raise ValueError(f'{scores_csv} is not the result of a shard.')
+  shard, n_shards = int(match.group(1)), int(match.group(2))
+  suffix = SHARD_PATTERN.sub('', shard_suffix)
+  return (shard, n_shards, suffix, scores_csv,
+          wordpair_csv[0] if wordpair_csv else None,
+          os.path.join(shard_dir, 'info.txt'))
+
+def read_csv_as_text(path):
+  '''reads csv keeping all fields as the strings written (to write them back unchanged)'''
+  return pd.read_csv(path, dtype=str, keep_default_na=False)
+
+def scores_from_df(scores_df):
+  '''rebuilds the entries of the scores of each sentence that the means are computed from,
+  from the scores csv'''
+  def column(name):
+    return pd.to_numeric(scores_df[name], errors='coerce').to_numpy()
+  all_scores = [{'nonproj': {'uuas': {}}, 'projective': {'uuas': {}}}
+                for _ in range(len(scores_df))]
+  names = ['baseline_linear', 'baseline_random_nonproj', 'baseline_random_proj']
+  if 'gold_edges_outside_window' in scores_df:
+    names += ['number_edges', 'gold_edges_outside_window']
+  for name in names:
+    for scores, value in zip(all_scores, column(name)):
+      scores[name] = value
+  for parsetype in ['nonproj', 'projective']:
+    for symmetrize_method in SYMMETRIZE_METHODS:
+      values = column(f'{parsetype}.uuas.{symmetrize_method}')
+      for scores, value in zip(all_scores, values):
+        scores[parsetype]['uuas'][symmetrize_method] = value
+  if 'directed.uas' in scores_df:
+    for scores, value in zip(all_scores, column('directed.uas')):
+      scores['directed'] = {'uas': value}
+  return all_scores
+
+def read_info(info_txt):
+  '''
+  splits info.txt into the run arguments, the throughput totals,
+  and the remaining sections (other than the mean uuas values)
+  '''
+  with open(info_txt) as infofile:
+    args, *sections = infofile.read().split('=========\n')
+  timing = {'sentences': 0, 'tasks': 0, 'seconds': 0.}
+  other_sections = []
+  for section in sections:
+    if section.startswith('estimation throughput'):
+      match = re.search(r'(\d+) sentences, (\d+) tasks in ([\d.]+)s', section)
+      timing = {'sentences': int(match.group(1)), 'tasks': int(match.group(2)),
+                'seconds': float(match.group(3))}
+    elif not section.startswith('mean uuas values'):
+      other_sections.append(section)
+  return args, timing, other_sections
+
+def merge_shards(shard_dirs, results_dir):
+  '''merges the results in shard_dirs into a new directory in results_dir
+  returns: the path of the new directory'''
+  shards = sorted(find_results(shard_dir) for shard_dir in shard_dirs)
+  n_shards = shards[0][1]
+  if [shard[0] for shard in shards] != list(range(n_shards)) or any(
+      shard[1] != n_shards for shard in shards):
+    raise ValueError(f'Expected the results of shards 0 to {n_shards-1} of {n_shards}, '
+                     f'got {[shard[0] for shard in shards]}.')
+  suffix = shards[0][2]
+  merged_dir = os.path.join(results_dir, suffix + '/')
+  os.makedirs(merged_dir, exist_ok=True)
+  print(f'Merging {n_shards} shards into {merged_dir}')
+
+  # scores, ordered by sentence index
+  scores_df = pd.concat([read_csv_as_text(shard[3]) for shard in shards])
+  scores_df = scores_df.sort_values(
+    'sentence_index', key=lambda x: x.astype(int), kind='stable')
+  scores_df.to_csv(merged_dir + 'scores_' + suffix + '.csv', index=False)
+
+  # wordpair data, ordered by sentence index (the order of rows within a sentence is kept)
+  wordpair_dfs = [read_csv_as_text(shard[4]) for shard in shards if shard[4]]
+  if wordpair_dfs:
+    wordpair_df = pd.concat(wordpair_dfs).sort_values(
+      'sentence_index', key=lambda x: x.astype(int), kind='stable')
+    wordpair_df.to_csv(merged_dir + 'wordpair_' + suffix + '.csv', index=False)
+
+  # info: run arguments (as for an unsharded run), recomputed means, total throughput
+  infos = [read_info(shard[5]) for shard in shards]
+  args = re.sub(r'^shard:\t.*$', 'shard:\tNone', infos[0][0], flags=re.MULTILINE)
+  with open(merged_dir + 'info.txt', mode='w') as infofile:
+    infofile.write(args)
+  main.print_means_to_file(scores_from_df(scores_df), merged_dir + 'info.txt')
+  timing = {key: sum(info[1][key] for info in infos) for key in infos[0][1]}
+  if timing['seconds'] > 0:
+    main.print_throughput_to_file(timing, merged_dir + 'info.txt')
+  # other sections (like the fp32 check, which is the same for every shard) from shard 0
+  with open(merged_dir + 'info.txt', mode='a') as infofile:
+    for section in infos[0][2]:
+      infofile.write('=========\n' + section)
+  return merged_dir
+
+if __name__ == '__main__':
+  ARGP = ArgumentParser()
+  ARGP.add_argument('shard_dirs', nargs='+',
+                    help='path/to/results/directory/ of each shard')
+  ARGP.add_argument('--results_dir', default='results/',
+                    help='specify path/to/results/directory/ to put the merged results in')
+  CLI_ARGS = ARGP.parse_args()
+  merge_shards(CLI_ARGS.shard_dirs, CLI_ARGS.results_dir)
@@ -11,39 +11,15 @@ import numpy as np
 # This corresponds to the symbols which are UPOS tagged as PUNCT
 EXCLUDED_PUNCTUATION = ["", "'", "''", ",", ".", ";", "!", "?", ":", "``", "-LRB-", "-RRB-"]
 
-class UnionFind:
-  '''
-  Naive UnionFind (for computing MST with Prim's algorithm).
-  '''
-  def __init__(self, n):
-    self.parents = list(range(n))
-  def union(self, i, j):
-    '''
-    join i and j
-    '''
-    if self.find(i) != self.find(j):
-      i_parent = self.find(i)
-      self.parents[i_parent] = j
-  def find(self, i):
-    '''
-    find parent of i
-    '''
-    i_parent = i
-    while True:
-      if i_parent != self.parents[i_parent]:
-        i_parent = self.parents[i_parent]
-      else:
-        break
-    return i_parent
-
 class Accuracy:
   '''
   Gets accuracy score for list of edges wrt gold list of edges.
   '''
-  def __init__(self, gold_edges):
+  def __init__(self, gold_edges, gold_heads=None):
     self.gold_edges = gold_edges
     self.gold_edges_set = {tuple(sorted(x)) for x in gold_edges}
     self.n_gold = len(gold_edges)
+    self.gold_heads = gold_heads
 
   def uuas(self, prediction_edges):
     '''
@@ -55,6 +31,18 @@ class Accuracy:
     uuas = len(common)/float(self.n_gold) if self.n_gold != 0 else np.NaN
     return uuas
 
+  def uas(self, prediction_heads):
+    '''
+    gets directed uas accuracy score (num words with the gold head/num words),
+    for the head of each word (-1 for the root) as arborescence gives,
+    over the words which have a gold head (not None)
+    '''
+    scored = [(head, gold_head) for head, gold_head in zip(prediction_heads, self.gold_heads)
+              if gold_head is not None]
+    correct = sum(head == gold_head for head, gold_head in scored)
+    uas = correct/float(len(scored)) if scored else np.NaN
+    return uas
+
 class DepParse:
   """Gets tree as MST from matrix of distances"""
 
@@ -75,55 +63,244 @@ class DepParse:
         'sum' (default): sums matrix with transpose of matrix;
         'triu': uses only the upper triangle of matrix;
         'tril': uses only the lower triangle of matrix;
-        'none': uses the optimum weight for each unordered pair of edges.
-    returns: tree (list of edges)
+        'none': uses the optimum weight for each unordered pair of edges
+          (or, with parsetype 'directed_mst', the matrix as it is).
+    returns: tree (list of edges),
+      or for parsetype 'directed_mst', the head of each word (see arborescence)
     '''
-    sym_matrix = self.matrix
-    if symmetrize_method == 'sum':
-      sym_matrix = sym_matrix + np.transpose(sym_matrix)
-    elif symmetrize_method == 'triu':
-      sym_matrix = np.triu(sym_matrix) + np.transpose(np.triu(sym_matrix))
-    elif symmetrize_method == 'tril':
-      sym_matrix = np.tril(sym_matrix) + np.transpose(np.tril(sym_matrix))
-    elif symmetrize_method != 'none':
-      raise ValueError("Unknown symmetrize_method. Use 'sum', 'triu', 'tril', or 'none'")
+    sym_matrix = self.symmetrize(self.matrix, symmetrize_method)
 
     if self.parsetype == "mst":
       edges = self.prims(sym_matrix, self.words, maximum_spanning_tree=maximum_spanning_tree)
     elif self.parsetype == "projective":
       edges = self.eisners(sym_matrix, self.words)
+    elif self.parsetype == "directed_mst":
+      edges = self.arborescence(sym_matrix, self.words)
     else:
-      raise ValueError("Unknown parsetype.  Choose 'mst' or 'projective'")
-    if self.parsetype == "projective" and not maximum_spanning_tree:
-      raise ValueError("Please only use Eisner's algorithm for maximum_spanning_tree.")
+      raise ValueError("Unknown parsetype.  Choose 'mst', 'projective', or 'directed_mst'")
+    if self.parsetype in ["projective", "directed_mst"] and not maximum_spanning_tree:
+      raise ValueError(f"Please only use parsetype '{self.parsetype}' for maximum_spanning_tree.")
     return edges
 
+  @staticmethod
+  def symmetrize(matrix, symmetrize_method='sum'):
+    '''
+    Symmetrizes matrix with symmetrize_method ('sum', 'triu', 'tril', or 'none', see tree)
+    '''
+    if symmetrize_method == 'sum':
+      return matrix + np.transpose(matrix)
+    if symmetrize_method == 'triu':
+      return np.triu(matrix) + np.transpose(np.triu(matrix))
+    if symmetrize_method == 'tril':
+      return np.tril(matrix) + np.transpose(np.tril(matrix))
+    if symmetrize_method != 'none':
+      raise ValueError("Unknown symmetrize_method. Use 'sum', 'triu', 'tril', or 'none'")
+    return matrix
+
   @staticmethod
   def prims(matrix, words, maximum_spanning_tree=True):
     '''
-    Constructs a maximum spanning tree using Prim's algorithm.
+    Constructs a maximum spanning tree using Prim's algorithm, on the dense matrix (O(n^2)).
       (set maximum_spanning_tree=False to get minumum spanning tree instead).
-    Input: matrix (torch tensor of PMIs), words (list of tokens)
+    Input: matrix (numpy array or torch tensor of PMIs), words (list of tokens)
     Excludes edges to/from punctuation symbols or empty strings, and sets np.NaN to -inf
-    Returns: tree (list of edges).
+    Each pair of words is weighted by the better of matrix[i][j] and matrix[j][i], and
+    ties are broken by position in the matrix (row by row), so the tree is the same as
+    Kruskal's algorithm on the sorted entries of matrix would give.
+    Returns: tree (list of edges (i, j), as the better entry of each pair),
+    from best to worst.
     Based on code by John Hewitt.
     '''
-    pairs_to_weights = {}
-    excluded = EXCLUDED_PUNCTUATION
-    union_find = UnionFind(len(matrix))
-    for i_index, line in enumerate(matrix):
-      for j_index, dist in enumerate(line):
-        if words[i_index] in excluded: continue
-        if words[j_index] in excluded: continue
-        pairs_to_weights[(i_index, j_index)] = dist
-    edges = []
-    for (i_index, j_index), _ in sorted(pairs_to_weights.items(),
-                                        key=lambda x: float('-inf') if (x[1] != x[1]) else x[1],
-                                        reverse=maximum_spanning_tree):
-      if union_find.find(i_index) != union_find.find(j_index):
-        union_find.union(i_index, j_index)
-        edges.append((i_index, j_index))
-    return edges
+    return DepParse.prims_batch(
+      [matrix], excluded=[[word in EXCLUDED_PUNCTUATION for word in words]],
+      maximum_spanning_tree=maximum_spanning_tree)[0]
+
+  @staticmethod
+  def prims_batch(matrices, lengths=None, excluded=None, maximum_spanning_tree=True):
+    '''
+    Prim's algorithm (as in prims) for a batch of matrices at once,
+    growing the trees of all of them in lock-step.
+    Input: matrices (B-by-n-by-n array or tensor, padded, or list of square matrices),
+      lengths (number of words of each matrix, by default all of it),
+      excluded (B-by-n bools, True for the words to leave out of each tree, by default none),
+      maximum_spanning_tree (bool, or one for each matrix)
+    Returns: list of B trees (list of edges, as prims gives)
+    '''
+    if lengths is None:
+      lengths = [len(matrix) for matrix in matrices]
+    batch_size, n = len(lengths), max(lengths, default=0)
+    if n == 0:
+      return [[] for _ in lengths]
+    if np.ndim(maximum_spanning_tree) == 0:
+      maximum_spanning_tree = [maximum_spanning_tree] * batch_size
+    # words beyond the length of each matrix are left out too
+    weights = np.zeros((batch_size, n, n))
+    included = np.zeros((batch_size, n), dtype=bool)
+    for b, length in enumerate(lengths):
+      weights[b, :length, :length] = np.array(matrices[b], dtype=float)[:length, :length]
+      included[b, :length] = True
+      if excluded is not None:
+        included[b, :length] &= ~np.array(excluded[b][:length], dtype=bool)
+    weights[np.isnan(weights)] = -np.inf
+    weights[~np.array(maximum_spanning_tree, dtype=bool)] *= -1
+
+    # the better entry of each pair (the first one, if they are equal),
+    # and its position in the matrix
+    position = np.arange(n*n).reshape(n, n)
+    weights_t = np.swapaxes(weights, 1, 2)
+    transposed = (weights_t > weights) | ((weights_t == weights) & (position.T < position))
+    pair_weights = np.where(transposed, weights_t, weights)
+    pair_position = np.where(transposed, position.T, position)
+
+    # grow each tree from its first word, adding the best edge to a word outside it each time
+    # (best by weight, then position); best_weights[b, j], best_position[b, j] for the best
+    # edge to j
+    items = np.arange(batch_size)
+    n_nodes = included.sum(axis=1)
+    in_tree = ~included
+    first_nodes = np.argmax(included, axis=1)
+    in_tree[items, first_nodes] = True
+    best_weights = pair_weights[items, first_nodes].copy()
+    best_position = pair_position[items, first_nodes].copy()
+    n_steps = max(max(n_nodes) - 1, 0)
+    edge_weights = np.zeros((batch_size, n_steps))
+    edge_position = np.zeros((batch_size, n_steps), dtype=int)
+    for step in range(n_steps):
+      active = items[n_nodes - 1 > step]
+      outside = ~in_tree[active]
+      top_weights = np.max(np.where(outside, best_weights[active], -np.inf), axis=1)
+      candidates = outside & (best_weights[active] == top_weights[:, None])
+      new_nodes = np.argmin(np.where(candidates, best_position[active], n*n), axis=1)
+      edge_weights[active, step] = best_weights[active, new_nodes]
+      edge_position[active, step] = best_position[active, new_nodes]
+      in_tree[active, new_nodes] = True
+      new_weights = pair_weights[active, new_nodes]
+      new_position = pair_position[active, new_nodes]
+      better = ((new_weights > best_weights[active])
+                | ((new_weights == best_weights[active])
+                   & (new_position < best_position[active])))
+      best_weights[active] = np.where(better, new_weights, best_weights[active])
+      best_position[active] = np.where(better, new_position, best_position[active])
+
+    trees = []
+    for b, n_edges in enumerate(np.maximum(n_nodes - 1, 0)):
+      # from best to worst edge (then by position)
+      order = np.lexsort((edge_position[b, :n_edges], -edge_weights[b, :n_edges]))
+      positions = edge_position[b, :n_edges][order]
+      trees.append(list(zip((positions // n).tolist(), (positions % n).tolist())))
+    return trees
+
+  @staticmethod
+  def arborescence(matrix, words):
+    '''
+    Directed maximum spanning tree (arborescence) with the Chu-Liu/Edmonds algorithm,
+    on the raw, nonsymmetric matrix: entry matrix[head][dep] is the score for the arc
+    from head to dep.
+    Excludes punctuation symbols or empty strings, as eisners does, and pairs with
+    no score (np.NaN) can't be arcs.
+    Exactly one word is the root (unless no tree without missing arcs exists):
+    arcs from the root all get the same score, low enough that each extra root arc
+    costs more than any tree of word arcs can gain.
+    Returns: heads (list of the head of each word, -1 for the root word,
+    and None for excluded words)
+    '''
+    matrix = np.array(matrix, dtype=float)
+    included = [index for index, word in enumerate(words) if word not in EXCLUDED_PUNCTUATION]
+    heads = [None] * len(words)
+    N = len(included)
+    if N == 0:
+      return heads
+    # scores[head][dep], with the root at index 0
+    scores = np.full((N+1, N+1), -np.inf)
+    word_scores = matrix[np.ix_(included, included)]
+    word_scores[np.isnan(word_scores)] = -np.inf
+    finite = np.isfinite(word_scores)
+    lowest = np.min(word_scores[finite]) if finite.any() else 0.
+    highest = np.max(word_scores[finite]) if finite.any() else 0.
+    scores[1:, 1:] = word_scores
+    scores[0, 1:] = (N-1) * lowest - (N-2) * highest - 1
+    np.fill_diagonal(scores, -np.inf)
+
+    for dep, head in enumerate(DepParse.chu_liu_edmonds(scores)[1:]):
+      heads[included[dep]] = included[head-1] if head > 0 else -1
+    return heads
+
+  @staticmethod
+  def chu_liu_edmonds(scores):
+    '''
+    Maximum spanning arborescence rooted at node 0 of the (N+1)-by-(N+1) array of arc
+    scores[head][dep] (-inf for no arc; every node must be reachable from the root).
+    Dense O(N^2) version (after Tarjan): follows the best incoming arcs back from each
+    node until reaching the tree grown from the root, contracting each cycle found on the
+    way into a new node, whose incoming arcs are rescored relative to the cycle arcs they
+    would replace. The arcs chosen for contracted nodes are then expanded top down.
+    Returns: array of the head of each node (-1 for the root)
+    '''
+    n_nodes = len(scores)
+    size = 2 * n_nodes # (at most n_nodes - 1 contractions)
+    # weight[u, v]: best (rescored) arc from node u into node v, and that arc (as head*n_nodes+dep)
+    weight = np.full((size, size), -np.inf)
+    weight[:n_nodes, :n_nodes] = scores
+    arc = np.zeros((size, size), dtype=int)
+    arc[:n_nodes, :n_nodes] = np.arange(n_nodes * n_nodes).reshape(n_nodes, n_nodes)
+    alive = np.zeros(size, dtype=bool)
+    alive[:n_nodes] = True
+    done = np.zeros(size, dtype=bool)
+    done[0] = True
+    in_weight = np.zeros(size)
+    in_arc = np.zeros(size, dtype=int)
+    parent = -np.ones(size, dtype=int)
+    members = {}
+    n_contracted = n_nodes
+
+    for start in range(1, n_nodes):
+      if done[start] or not alive[start]: # (already in the tree, or in a contracted node)
+        continue
+      path = []
+      node = start
+      while True:
+        candidates = np.where(alive, weight[:, node], -np.inf)
+        candidates[node] = -np.inf
+        head = int(np.argmax(candidates))
+        in_weight[node], in_arc[node] = candidates[head], arc[head, node]
+        if done[head]:
+          done[path + [node]] = True
+          break
+        if head not in path:
+          path.append(node)
+          node = head
+          continue
+        # contract the cycle head -> ... -> node -> head into a new node
+        cycle = path[path.index(head):] + [node]
+        del path[path.index(head):]
+        new = n_contracted
+        n_contracted += 1
+        rescored = weight[:, cycle] - in_weight[cycle]
+        best = np.argmax(rescored, axis=1)
+        weight[:, new] = rescored[np.arange(size), best]
+        arc[:, new] = arc[:, cycle][np.arange(size), best]
+        best = np.argmax(weight[cycle, :], axis=0)
+        weight[new, :] = weight[cycle, :][best, np.arange(size)]
+        arc[new, :] = arc[cycle, :][best, np.arange(size)]
+        weight[new, new] = -np.inf
+        alive[cycle] = False
+        alive[new] = True
+        parent[cycle] = new
+        members[new] = cycle
+        node = new
+
+    # expand: the arc into each contracted node replaces the cycle arc into the
+    # member containing its dep
+    chosen = np.where(alive, in_arc, -1)
+    for new in range(n_contracted - 1, n_nodes - 1, -1):
+      member = chosen[new] % n_nodes
+      while parent[member] != new:
+        member = parent[member]
+      for node in members[new]:
+        chosen[node] = chosen[new] if node == member else in_arc[node]
+    heads = chosen[:n_nodes] // n_nodes
+    heads[0] = -1
+    return heads
 
   def eisners(self, matrix, words):
     """
@@ -132,7 +309,58 @@ class DepParse:
     based on DependencyDecoder class from lxmls-toolkit
     https://github.com/LxMLS/lxmls-toolkit/blob/master/lxmls/parsing/dependency_decoder.py
     """
+    return self.eisners_batch([matrix], [words])[0]
+
+  @staticmethod
+  def eisners_batch(matrices, words_list):
+    """
+    Parses several matrices at once (as eisners does each), in a single batch,
+    for instance the symmetrizations of a sentence's matrix, or the matrices of many sentences.
+    Input: matrices (arrays or torch tensors, matrix[head][dep]), and the words of each
+    Returns: list of trees (list of edges), one per matrix
+    """
+    prepared = [DepParse._eisners_scores(matrix, words)
+                for matrix, words in zip(matrices, words_list)]
+    lengths = [len(scores) - 1 for scores, _, _ in prepared]
+    N = max(lengths)
+    padded_scores = np.zeros((len(prepared), N+1, N+1))
+    for b, (scores, _, _) in enumerate(prepared):
+      padded_scores[b, :len(scores), :len(scores)] = scores
+    batch_heads = DepParse.eisners_batch_heads(padded_scores, lengths)
+
+    trees = []
+    for (scores, missing, wordnum_to_index), length, heads in zip(
+        prepared, lengths, batch_heads):
+      heads = heads[:length+1]
+      if np.sum(heads[1:] == 0) > 1:
+        # The best tree has more than one arc from the root (when there is no tree without
+        # missing arcs, or word scores are below the root's): redo with missing arcs as the
+        # worst arcs, and a root score low enough that no tree has more than one root arc.
+        word_scores = scores[1:, 1:]
+        finite = np.isfinite(word_scores)
+        lowest = np.min(word_scores[finite]) if finite.any() else 0.
+        highest = np.max(word_scores[finite]) if finite.any() else 0.
+        if missing.any():
+          lowest -= 1
+          word_scores[missing[1:, 1:]] = lowest
+        scores[0, :] = (length-1) * lowest - (length-2) * highest - 1
+        heads, = DepParse.eisners_batch_heads(scores[None], [length])
+
+      edgelist = list(enumerate(heads))
+      # Eisner edges, sorted, removing the root node (taking indices [2:] and shifting all values -1)
+      sortededges_noroot = sorted({tuple(sorted(tuple([i-1 for i in edge]))) for edge in edgelist})[2:]
+      # Now with indices translated to give word-to-word edges (simply skipping puncuation indices)
+      trees.append([tuple(wordnum_to_index[w] for w in pair) for pair in sortededges_noroot])
+    return trees
 
+  @staticmethod
+  def _eisners_scores(matrix, words):
+    """
+    Gets the arc scores for Eisner's algorithm from matrix: the words that are not
+    excluded, and the root (index 0).
+    Returns: scores, which of them are missing (NaN in matrix),
+    and the map of rows of scores (after the root) to word indices
+    """
     # with np.printoptions(precision=2, suppress=True):
     #   print(f"raw input matrix for eisners\n{matrix.numpy()}")
 
@@ -160,62 +388,74 @@ class DepParse:
     matrix_paddedcol = np.concatenate((col_zeros, matrix), 1)
     row_zeros = np.zeros((1, matrix_paddedcol.shape[1])).reshape(1, -1) - 50
     scores = np.concatenate([row_zeros, matrix_paddedcol], 0)
+    # missing scores (pairs with no PMI estimate) can't be arcs (but see eisners_batch)
+    missing = np.isnan(scores)
+    scores[missing] = -np.inf
+    return scores, missing, wordnum_to_index
 
-    # ---- begin algorithm ------
-
-    nrows, ncols = np.shape(scores)
+  @staticmethod
+  def eisners_batch_heads(scores, lengths):
+    """
+    Eisner's algorithm for a batch of B padded (N+1)-by-(N+1) arrays of arc scores
+    scores[b][head][dep] (index 0 being the root), for sentences of lengths[b] <= N words.
+    All items are decoded in the same vectorized pass (entries beyond an item's length are ignored).
+    Returns: (B, N+1) array of the head of each word in the best tree of each item
+    (-1 for the root, and beyond the item's length)
+    """
+    scores = np.asarray(scores, dtype=float)
+    batch_size, nrows, ncols = np.shape(scores)
     if nrows != ncols:
-      raise ValueError("scores must be a nparray with nw+1 rows")
-
+      raise ValueError("scores must be nparrays with nw+1 rows")
     N = nrows - 1  # Number of words (excluding root).
 
     # Initialize CKY table.
-    complete = np.zeros([N+1, N+1, 2])  # s, t, direction (right=1).
-    incomplete = np.zeros([N+1, N+1, 2])  # s, t, direction (right=1).
-    complete_backtrack = -np.ones([N+1, N+1, 2], dtype=int)  # s, t, direction (right=1).
-    incomplete_backtrack = -np.ones([N+1, N+1, 2], dtype=int)  # s, t, direction (right=1).
+    complete = np.zeros([batch_size, N+1, N+1, 2])  # b, s, t, direction (right=1).
+    incomplete = np.zeros([batch_size, N+1, N+1, 2])  # b, s, t, direction (right=1).
+    complete_backtrack = -np.ones([batch_size, N+1, N+1, 2], dtype=int)  # b, s, t, direction (right=1).
+    incomplete_backtrack = -np.ones([batch_size, N+1, N+1, 2], dtype=int)  # b, s, t, direction (right=1).
 
-    incomplete[0, :, 0] -= np.inf
+    incomplete[:, 0, :, 0] -= np.inf
 
-    # Loop from smaller items to larger items.
+    # Loop from smaller items to larger items, doing all spans of width k at once
+    # (a span only depends on the spans within it, so spans within an item's length
+    # are the same as for that item alone):
+    # the arrays below are indexed by item, span (s, t=s+k), and split point s+m
     for k in range(1, N+1):
-      for s in range(N-k+1):
-        t = s + k
-
-        # First, create incomplete items.
-        # left tree
-        incomplete_vals0 = complete[s, s:t, 1] + complete[(s+1):(t+1), t, 0] + scores[t, s]
-        incomplete[s, t, 0] = np.max(incomplete_vals0)
-        incomplete_backtrack[s, t, 0] = s + np.argmax(incomplete_vals0)
-        # right tree
-        incomplete_vals1 = complete[s, s:t, 1] + complete[(s+1):(t+1), t, 0] + scores[s, t]
-        incomplete[s, t, 1] = np.max(incomplete_vals1)
-        incomplete_backtrack[s, t, 1] = s + np.argmax(incomplete_vals1)
-
-        # Second, create complete items.
-        # left tree
-        complete_vals0 = complete[s, s:t, 0] + incomplete[s:t, t, 0]
-        complete[s, t, 0] = np.max(complete_vals0)
-        complete_backtrack[s, t, 0] = s + np.argmax(complete_vals0)
-        # right tree
-        complete_vals1 = incomplete[s, (s+1):(t+1), 1] + complete[(s+1):(t+1), t, 1]
-        complete[s, t, 1] = np.max(complete_vals1)
-        complete_backtrack[s, t, 1] = s + 1 + np.argmax(complete_vals1)
-
-    # value = complete[0][N][1]
-    heads = -np.ones(N + 1, dtype=int)
-    self.eisners_backtrack(incomplete_backtrack, complete_backtrack, 0, N, 1, 1, heads)
-
-    # ---- end algorithm -----------
-
-    edgelist = list(enumerate(heads))
-    # Eisner edges, sorted, removing the root node (taking indices [2:] and shifting all values -1)
-    sortededges_noroot = sorted({tuple(sorted(tuple([i-1 for i in edge]))) for edge in edgelist})[2:]
-    # Now with indices translated to give word-to-word edges (simply skipping puncuation indices)
-    edges = [tuple(wordnum_to_index[w] for w in pair) for pair in sortededges_noroot]
-    return edges
+      s = np.arange(N-k+1)[:, None]
+      t = s + k
+      r = s + np.arange(k)[None, :]  # s, ..., t-1
+      span_s, span_t = s[:, 0], t[:, 0]
+
+      # First, create incomplete items.
+      incomplete_vals = complete[:, s, r, 1] + complete[:, r+1, t, 0]
+      # left tree
+      incomplete_vals0 = incomplete_vals + scores[:, t, s]
+      incomplete[:, span_s, span_t, 0] = np.max(incomplete_vals0, axis=2)
+      incomplete_backtrack[:, span_s, span_t, 0] = span_s + np.argmax(incomplete_vals0, axis=2)
+      # right tree
+      incomplete_vals1 = incomplete_vals + scores[:, s, t]
+      incomplete[:, span_s, span_t, 1] = np.max(incomplete_vals1, axis=2)
+      incomplete_backtrack[:, span_s, span_t, 1] = span_s + np.argmax(incomplete_vals1, axis=2)
+
+      # Second, create complete items.
+      # left tree
+      complete_vals0 = complete[:, s, r, 0] + incomplete[:, r, t, 0]
+      complete[:, span_s, span_t, 0] = np.max(complete_vals0, axis=2)
+      complete_backtrack[:, span_s, span_t, 0] = span_s + np.argmax(complete_vals0, axis=2)
+      # right tree
+      complete_vals1 = incomplete[:, s, r+1, 1] + complete[:, r+1, t, 1]
+      complete[:, span_s, span_t, 1] = np.max(complete_vals1, axis=2)
+      complete_backtrack[:, span_s, span_t, 1] = span_s + 1 + np.argmax(complete_vals1, axis=2)
+
+    # value = complete[b][0][lengths[b]][1]
+    heads = -np.ones([batch_size, N+1], dtype=int)
+    for b, length in enumerate(lengths):
+      DepParse.eisners_backtrack(
+        incomplete_backtrack[b], complete_backtrack[b], 0, length, 1, 1, heads[b])
+    return heads
 
-  def eisners_backtrack(self, incomplete_backtrack, complete_backtrack, s, t, direction, complete, heads):
+  @staticmethod
+  def eisners_backtrack(incomplete_backtrack, complete_backtrack, s, t, direction, complete, heads):
     """
     Backtracking step in Eisner's algorithm.
     - incomplete_backtrack is a (NW+1)-by-(NW+1) numpy array indexed by a start position,
@@ -231,27 +471,26 @@ class DepParse:
     - heads is a (NW+1)-sized numpy array of integers which is a placeholder for storing the
     head of each word.
     """
-    if s == t:
-      return
-    if complete:
-      r = complete_backtrack[s][t][direction]
-      if direction == 0:
-        self.eisners_backtrack(incomplete_backtrack, complete_backtrack, s, r, 0, 1, heads)
-        self.eisners_backtrack(incomplete_backtrack, complete_backtrack, r, t, 0, 0, heads)
-        return
-      else:
-        self.eisners_backtrack(incomplete_backtrack, complete_backtrack, s, r, 1, 0, heads)
-        self.eisners_backtrack(incomplete_backtrack, complete_backtrack, r, t, 1, 1, heads)
-        return
-    else:
-      r = incomplete_backtrack[s][t][direction]
-      if direction == 0:
-        heads[s] = t
-        self.eisners_backtrack(incomplete_backtrack, complete_backtrack, s, r, 1, 1, heads)
-        self.eisners_backtrack(incomplete_backtrack, complete_backtrack, r+1, t, 0, 1, heads)
-        return
+    # (iterative, with a stack of the spans left to visit, so long sentences can't
+    # hit the recursion limit)
+    stack = [(s, t, direction, complete)]
+    while stack:
+      s, t, direction, complete = stack.pop()
+      if s == t:
+        continue
+      if complete:
+        r = complete_backtrack[s][t][direction]
+        if direction == 0:
+          stack.append((s, r, 0, 1))
+          stack.append((r, t, 0, 0))
+        else:
+          stack.append((s, r, 1, 0))
+          stack.append((r, t, 1, 1))
       else:
-        heads[t] = s
-        self.eisners_backtrack(incomplete_backtrack, complete_backtrack, s, r, 1, 1, heads)
-        self.eisners_backtrack(incomplete_backtrack, complete_backtrack, r+1, t, 0, 1, heads)
-        return
+        r = incomplete_backtrack[s][t][direction]
+        if direction == 0:
+          heads[s] = t
+        else:
+          heads[t] = s
+        stack.append((s, r, 1, 1))
+        stack.append((r+1, t, 0, 1))
@@ -0,0 +1,191 @@
+"""
+A queue of chunks of work shared by any number of worker processes
+(on one host, or on several hosts sharing a filesystem) through a directory,
+using lock files created atomically (O_EXCL) to claim chunks.
+No server is needed.
+-
+Layout of the queue directory:
+  chunks.json          the chunks (lists of sentence indices), written once
+  chunk00012.claim     claim on chunk 12 (refreshed while being worked on)
+  chunk00012/          results of chunk 12, once done (renamed in place when complete)
+  merge.claim          claim on merging all results, once all chunks are done
+"""
+
+import os
+import json
+import time
+import socket
+import shutil
+import threading
+
+class WorkQueue:
+  """
+  Chunks are claimed by creating their claim file with O_EXCL, which only
+  one process can do. A claim whose file has not been refreshed for
+  claim_timeout seconds (e.g. because its worker crashed) can be reclaimed.
+  Results of a chunk are written to a temporary directory that is
+  renamed to the chunk's results directory once complete.
+  """
+  def __init__(self, queue_dir, chunks, claim_timeout=600):
+    self.queue_dir = queue_dir
+    self.chunks = chunks
+    self.claim_timeout = claim_timeout
+    self.owner = f'{socket.gethostname()}-{os.getpid()}'
+    os.makedirs(queue_dir, exist_ok=True)
+    self._check_chunks()
+
+  def _path(self, name):
+    return os.path.join(self.queue_dir, name)
+
+  def _check_chunks(self):
+    '''records the chunks in the queue directory, or checks that they
+    are the ones already recorded there (by the first worker)'''
+    tmp_path = self._path(f'chunks.json.{self.owner}')
+    with open(tmp_path, 'w') as f:
+      json.dump(self.chunks, f)
+    try:
+      # (link is atomic, and fails if chunks.json exists)
+      os.link(tmp_path, self._path('chunks.json'))
+    except FileExistsError:
+      with open(self._path('chunks.json')) as f:
+        if json.load(f) != self.chunks:
+          raise ValueError(f'{self.queue_dir} is the queue of a different run.')
+    finally:
+      os.remove(tmp_path)
+
+  def result_dir(self, chunk_id):
+    return self._path(f'chunk{chunk_id:05}')
+
+  def is_done(self, chunk_id):
+    return os.path.isdir(self.result_dir(chunk_id))
+
+  def all_done(self):
+    return all(self.is_done(chunk_id) for chunk_id, _ in enumerate(self.chunks))
+
+  def _claim(self, name):
+    '''tries to claim by creating the claim file name (reclaiming it if stale)
+    returns: whether the claim succeeded'''
+    path = self._path(name)
+    try:
+      fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+      try:
+        if time.time() - os.path.getmtime(path) < self.claim_timeout:
+          return False
+        # stale: move it out of the way (only one process can succeed), then check
+        # it again, since another process may have reclaimed it in the meantime
+        stale_path = f'{path}.stale.{self.owner}'
+        os.rename(path, stale_path)
+      except FileNotFoundError:
+        return False
+      if time.time() - os.path.getmtime(stale_path) < self.claim_timeout:
+        # a live claim: put it back (unless yet another claim has been made)
+        self._restore(stale_path, path)
+        return False
+      print(f'Reclaiming stale claim {name}.')
+      os.remove(stale_path)
+      return self._claim(name)
+    with os.fdopen(fd, 'w') as f:
+      f.write(f'{self.owner}\n')
+    return True
+
+  def _restore(self, moved_path, path):
+    '''moves the claim file at moved_path back to path, unless path exists'''
+    try:
+      # (link is atomic, and fails if path exists)
+      os.link(moved_path, path)
+    except FileExistsError:
+      pass
+    os.remove(moved_path)
+
+  def _is_owned(self, path):
+    try:
+      with open(path) as f:
+        return f.read() == f'{self.owner}\n'
+    except FileNotFoundError:
+      return False
+
+  def _release(self, name):
+    '''removes the claim file name, if it is still this worker's claim'''
+    path = self._path(name)
+    released_path = f'{path}.released.{self.owner}'
+    try:
+      os.rename(path, released_path)
+    except FileNotFoundError:
+      return
+    if self._is_owned(released_path):
+      os.remove(released_path)
+    else:
+      # reclaimed by another worker (after this claim went stale)
+      self._restore(released_path, path)
+
+  def _heartbeat(self, name, stop):
+    '''refreshes the claim file name until stop is set
+    (or until it is no longer this worker's claim)'''
+    path = self._path(name)
+    while not stop.wait(self.claim_timeout / 4):
+      try:
+        with open(path) as f:
+          if f.read() != f'{self.owner}\n':
+            return
+        os.utime(path)
+      except FileNotFoundError:
+        # (another worker may have moved it aside for a moment, to check it)
+        continue
+
+  def _start_heartbeat(self, name):
+    '''returns: the event that stops refreshing the claim file name'''
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=self._heartbeat, args=(name, stop), daemon=True)
+    heartbeat.start()
+    return stop
+
+  def claims(self, order=None, poll_interval=None):
+    '''
+    Claims chunks one at a time (in the given order of chunk ids, by default in order),
+    until all chunks are done. While chunks claimed by other workers are unfinished,
+    waits, in case their claims go stale.
+    yields: chunk_id, the chunk, and a new directory for its results,
+      which becomes the chunk's results directory when the caller asks for the next chunk
+      (if the caller fails instead, the chunk's claim goes stale and is taken by another worker)
+    '''
+    order = range(len(self.chunks)) if order is None else order
+    poll_interval = poll_interval or self.claim_timeout / 4
+    while not self.all_done():
+      claimed = False
+      for chunk_id in order:
+        name = f'chunk{chunk_id:05}.claim'
+        if self.is_done(chunk_id) or not self._claim(name):
+          continue
+        claimed = True
+        # (a previous claim may have finished the chunk just before going stale)
+        if self.is_done(chunk_id):
+          self._release(name)
+          continue
+        work_dir = self._path(f'tmp-chunk{chunk_id:05}-{self.owner}/')
+        shutil.rmtree(work_dir, ignore_errors=True)
+        os.makedirs(work_dir)
+        stop = self._start_heartbeat(name)
+        try:
+          yield chunk_id, self.chunks[chunk_id], work_dir
+        finally:
+          stop.set()
+        try:
+          os.rename(work_dir, self.result_dir(chunk_id))
+        except OSError:
+          # done in the meantime by a worker that reclaimed it
+          shutil.rmtree(work_dir, ignore_errors=True)
+        self._release(name)
+      if not claimed and not self.all_done():
+        time.sleep(poll_interval)
+
+  def claim_merge(self):
+    '''whether this worker gets to merge the results (once all chunks are done)
+    (the claim is then refreshed for as long as this process runs)'''
+    if not (self.all_done() and self._claim('merge.claim')):
+      return False
+    self._start_heartbeat('merge.claim')
+    return True
+
+  def result_dirs(self):
+    return [self.result_dir(chunk_id) for chunk_id, _ in enumerate(self.chunks)]